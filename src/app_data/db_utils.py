@@ -1,13 +1,16 @@
 from src.file.file_object import PickableFile
+from src.app_data.ip_filter import IP_FILTER
 
 import asyncio
 import re
 from pathlib import Path
 import sqlite3
 import pickle
-from typing import Union, Any, Dict, List
+from typing import Union, Any, Dict, List, Set, Callable
 import json
 import threading
+import atexit
+import queue
 
 
 def get_configuration(config_to_get: str) -> Any:
@@ -95,34 +98,139 @@ class Singleton(object):
         return cls._instances[cls]
 
 
-class BannedPeersDB(Singleton):
+class BanWriter(object):
+    """
+    persists the changes to the banned peers in the background
+    changes are queued and written by one thread, one transaction per batch
+    """
+
     def __init__(self):
+        self.queue: queue.Queue = queue.Queue()
+        self.thread: Union[threading.Thread, None] = None
+        self.lock = threading.Lock()
+
+    def put(self, operation: str, ip_address: str):
+        """
+        :param operation: insert | delete
+        """
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.__loop, name='ban-writer', daemon=True)
+                self.thread.start()
+        self.queue.put((operation, ip_address))
+
+    def flush(self):
+        # waits until every queued change is written
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.join()
+
+    def __loop(self):
         conn = sqlite3.connect(abs_db_path('banned_peers.db'))
-        conn.cursor().execute('CREATE TABLE IF NOT EXISTS ip_addresses (ip_address TEXT PRIMARY KEY)')
-        conn.commit()
-        self.conn = conn
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < _BAN_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                cursor = conn.cursor()
+                for operation, ip_address in batch:
+                    if operation == 'insert':
+                        cursor.execute("INSERT OR IGNORE INTO ip_addresses (ip_address) VALUES (?)", (ip_address,))
+                    else:
+                        cursor.execute("DELETE FROM ip_addresses WHERE ip_address=?", (ip_address,))
+                conn.commit()
+            except sqlite3.Error as e:
+                print(f'failed to save banned peers: {e}')
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+
+_BAN_BATCH_SIZE = 1024
+BAN_WRITER = BanWriter()
+atexit.register(BAN_WRITER.flush)
+
+
+# called with every new ban of this process, the seeding workers forward bans to their processes
+BAN_LISTENERS: List[Callable[[str], None]] = []
+# set in a seeding worker process, its bans are saved by the main process
+_ban_forwarder: Union[Callable[[str], None], None] = None
+
+
+def set_ban_forwarder(forwarder: Callable[[str], None]):
+    global _ban_forwarder
+    _ban_forwarder = forwarder
+
+
+def ban_peer(ip_address: str):
+    """
+    bans a peer in every process: saves the ban and tells the seeding workers.
+    in a seeding worker the ban goes to the main process, which does the same
+    """
+    if _ban_forwarder is not None:
+        _ban_forwarder(ip_address)
+        return
+    BannedPeersDB().insert_ip(ip_address)
+    for listener in list(BAN_LISTENERS):
+        listener(ip_address)
+
+
+class BannedPeersDB(Singleton):
+    """
+    the banned peers are looked up in memory (IP_FILTER), with the blocklist of the configuration.
+    bans are saved to the database in the background
+    """
+    _loaded = False
+    _load_lock = threading.Lock()
+
+    def __init__(self):
+        if BannedPeersDB._loaded:
+            return
+        with BannedPeersDB._load_lock:
+            if BannedPeersDB._loaded:
+                return
+            conn = sqlite3.connect(abs_db_path('banned_peers.db'))
+            try:
+                conn.cursor().execute('CREATE TABLE IF NOT EXISTS ip_addresses (ip_address TEXT PRIMARY KEY)')
+                conn.commit()
+                for row in conn.cursor().execute('SELECT ip_address FROM ip_addresses'):
+                    IP_FILTER.add_ip(row[0])
+            finally:
+                conn.close()
+
+            blocklist = get_configuration('ip_filter')
+            if blocklist:
+                try:
+                    print(f'loaded {IP_FILTER.load_blocklist(blocklist)} blocked ranges')
+                except OSError as e:
+                    print(f'failed to load the ip filter: {e}')
+            BannedPeersDB._loaded = True
 
     def insert_ip(self, ip_address: str):
-        cursor = self.conn.cursor()
-        cursor.execute("INSERT OR IGNORE INTO ip_addresses (ip_address) VALUES (?)", (ip_address,))
-        self.conn.commit()
+        IP_FILTER.add_ip(ip_address)
+        BAN_WRITER.put('insert', ip_address)
 
     def find_ip(self, ip_address: str) -> bool:
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM ip_addresses WHERE ip_address=?", (ip_address,))
-        count = cursor.fetchone()[0]
-        return count > 0
+        return ip_address in IP_FILTER
+
+    def find_ips(self, ip_addresses: List[str]) -> Set[str]:
+        """
+        :return: the banned addresses among ip_addresses
+        """
+        return {ip_address for ip_address in ip_addresses if ip_address in IP_FILTER}
 
     def delete_ip(self, ip_address: str):
-        cursor = self.conn.cursor()
-        cursor.execute("DELETE FROM ip_addresses WHERE ip_address=?", (ip_address,))
-        self.conn.commit()
+        IP_FILTER.remove_ip(ip_address)
+        BAN_WRITER.put('delete', ip_address)
 
-    def __del__(self):
-        self.conn.close()
 
+class CompletedTorrentsConnection(object):
+    """
+    a connection of its own to the completed torrents db, for threads that must not share the singleton's one
+    """
 
-class CompletedTorrentsDB(Singleton):
     # TODO close and reopen file descriptors when needed, raising exception if the files don't exist
     def __init__(self):
         conn = sqlite3.connect(abs_db_path('completed_torrents.db'))
@@ -157,6 +265,11 @@ class CompletedTorrentsDB(Singleton):
         cursor.execute("DELETE FROM completed_torrents WHERE info_hash=?", (info_hash,))
         self.conn.commit()
 
+    def get_all_info_hashes(self) -> List[bytes]:
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT info_hash FROM completed_torrents")
+        return [row[0] for row in cursor.fetchall()]
+
     def get_all_torrents(self) -> List[PickableFile]:
         cursor = self.conn.cursor()
         cursor.execute("SELECT * FROM completed_torrents")
@@ -165,6 +278,45 @@ class CompletedTorrentsDB(Singleton):
             torrents.append(pickle.loads(torrent[1]))
         return torrents
 
+    def close(self):
+        self.conn.close()
+
+    def __del__(self):
+        self.conn.close()
+
+
+class CompletedTorrentsDB(CompletedTorrentsConnection, Singleton):
+    pass
+
+
+class ResumeDataDB(Singleton):
+    def __init__(self):
+        conn = sqlite3.connect(abs_db_path('resume_data.db'))
+        # info hash, pickled fast-resume record
+        conn.cursor().execute('CREATE TABLE IF NOT EXISTS resume_data (info_hash BLOB PRIMARY KEY, record BLOB)')
+        conn.commit()
+        self.conn = conn
+
+    def insert_record(self, record: Any):
+        params = (record.info_hash, pickle.dumps(record))
+        cursor = self.conn.cursor()
+        cursor.execute("INSERT OR REPLACE INTO resume_data (info_hash, record) VALUES (?, ?)", params)
+        self.conn.commit()
+
+    def get_record(self, info_hash: bytes) -> Any:
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT record FROM resume_data WHERE info_hash=?", (info_hash,))
+        record = cursor.fetchone()
+        if record:
+            return pickle.loads(record[0])
+        else:
+            return None
+
+    def delete_record(self, info_hash: bytes):
+        cursor = self.conn.cursor()
+        cursor.execute("DELETE FROM resume_data WHERE info_hash=?", (info_hash,))
+        self.conn.commit()
+
     def __del__(self):
         self.conn.close()
 
@@ -0,0 +1,197 @@
+from typing import Dict, Iterable, List, Set, Tuple, Union
+from bisect import bisect_right
+from array import array
+import ipaddress
+import threading
+import socket
+
+
+_ALLOWED_ACCESS = 128  # ipfilter.dat ranges with this access level or above are not blocked
+
+
+class IPFilter(object):
+    """
+    banned addresses, kept in memory
+    single ips are kept in a set, blocklist ranges (ipfilter.dat / p2p / cidr) are merged into
+    sorted arrays of range starts and ends per ip version and searched with bisect
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()  # guards building the ranges, lookups read a consistent snapshot
+        self.ips: Set[str] = set()
+        # ip version -> range starts, range ends (inclusive), sorted and disjoint
+        self.ranges: Dict[int, Tuple[Union[array, List[int]], Union[array, List[int]]]] = {4: (array('I'), array('I')), 6: ([], [])}
+
+    def __contains__(self, ip: str) -> bool:
+        if ip in self.ips or ('.' in ip and ':' in ip and _normalize(ip) in self.ips):
+            return True
+        value, version = _to_int(ip)
+        if value is None:
+            return False
+        starts, ends = self.ranges[version]
+        if not starts:
+            return False
+        index = bisect_right(starts, value) - 1
+        return index >= 0 and value <= ends[index]
+
+    def __len__(self) -> int:
+        return len(self.ips) + len(self.ranges[4][0]) + len(self.ranges[6][0])
+
+    def add_ip(self, ip: str):
+        self.ips.add(_normalize(ip))
+
+    def remove_ip(self, ip: str):
+        self.ips.discard(_normalize(ip))
+
+    def set_ranges(self, ranges: Iterable[Tuple[int, int, int]]):
+        """
+        replaces the blocked ranges
+        :param ranges: start, end (inclusive) as ints, ip version
+        """
+        by_version: Dict[int, List[Tuple[int, int]]] = {4: [], 6: []}
+        for start, end, version in ranges:
+            by_version[version].append((min(start, end), max(start, end)))
+
+        merged_ranges = dict()
+        for version, version_ranges in by_version.items():
+            starts, ends = (array('I'), array('I')) if version == 4 else ([], [])
+            for start, end in sorted(version_ranges):
+                if ends and start <= ends[-1] + 1:  # overlapping or adjacent
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            merged_ranges[version] = starts, ends
+
+        with self.lock:
+            self.ranges = merged_ranges
+
+    def load_blocklist(self, path: str) -> int:
+        """
+        loads a blocklist file, replacing the blocked ranges. supported lines:
+        p2p:         description:1.2.3.0-1.2.3.255
+        ipfilter.dat 001.002.003.000 - 001.002.003.255 , 000 , description
+        cidr / ip:   1.2.3.0/24, 2001:db8::/32, 1.2.3.4
+        :return: number of ranges read
+        """
+        ranges = []
+        with open(path, 'r', encoding='utf-8', errors='replace') as file:
+            for line in file:
+                parsed = parse_blocklist_line(line)
+                if parsed is not None:
+                    ranges.append(parsed)
+        self.set_ranges(ranges)
+        return len(ranges)
+
+
+def parse_blocklist_line(line: str) -> Union[Tuple[int, int, int], None]:
+    """
+    :return: start, end (inclusive) as ints, ip version | None if the line isn't a blocked range
+    """
+    line = line.strip()
+    if not line or line.startswith(('#', '//')):
+        return None
+
+    # p2p: description:range. descriptions may contain colons and commas and ipv6 ranges contain colons,
+    # the description ends at the first colon followed by a valid range. a bare range has no description
+    parsed = _parse_range(line)
+    colon = line.find(':')
+    while parsed is None and colon != -1:
+        parsed = _parse_range(line[colon + 1:])
+        colon = line.find(':', colon + 1)
+    if parsed is not None:
+        return parsed
+
+    try:
+        if ',' in line:
+            # ipfilter.dat: range , access , description
+            fields = line.split(',')
+            if int(fields[1]) >= _ALLOWED_ACCESS:
+                return None
+            return _parse_range(fields[0])
+
+        network = ipaddress.ip_network(line, strict=False)
+        return int(network.network_address), int(network.broadcast_address), network.version
+    except ValueError:
+        return None
+
+
+def _parse_range(address_range: str) -> Union[Tuple[int, int, int], None]:
+    """
+    :param address_range: start-end, both addresses of the same ip version
+    :return: start, end (inclusive) as ints, ip version | None if it isn't a valid range
+    """
+    start, _, end = address_range.partition('-')
+    start, start_version = _to_int(_strip_zeros(start.strip()))
+    end, end_version = _to_int(_strip_zeros(end.strip()))
+    if start is None or end is None or start_version != end_version:
+        return None
+    return start, end, start_version
+
+
+def _strip_zeros(ip: str) -> str:
+    # ipfilter.dat pads ipv4 octets with zeros, which would read as octal
+    if ':' not in ip and ip.count('.') == 3:
+        return '.'.join(str(int(octet)) if octet.isdigit() else octet for octet in ip.split('.'))
+    return ip
+
+
+def _to_int(ip: str) -> Tuple[Union[int, None], int]:
+    """
+    :return: address as an int (None if invalid), ip version (ipv4 mapped addresses are ipv4)
+    """
+    try:
+        if ':' not in ip:
+            return int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big'), 4
+        value = int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), 'big')
+    except (OSError, ValueError):
+        return None, 4
+    if value >> 32 == 0xFFFF:
+        return value & 0xFFFFFFFF, 4
+    return value, 6
+
+
+def _normalize(ip: str) -> str:
+    # the text form peers' addresses arrive in
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return ip
+    if address.version == 6 and address.ipv4_mapped:
+        address = address.ipv4_mapped
+    return str(address)
+
+
+IP_FILTER = IPFilter()
+
+
+if __name__ == '__main__':
+    def ip_range(start: str, end: str) -> Tuple[int, int, int]:
+        return int(ipaddress.ip_address(start)), int(ipaddress.ip_address(end)), ipaddress.ip_address(start).version
+
+    # p2p, the description may contain commas and colons
+    assert parse_blocklist_line('Bad Corp:1.2.3.0-1.2.3.255') == ip_range('1.2.3.0', '1.2.3.255')
+    assert parse_blocklist_line('Microsoft Corp, Inc:1.2.3.0-1.2.3.255') == ip_range('1.2.3.0', '1.2.3.255')
+    assert parse_blocklist_line('Evil: the corp, ltd:1.2.3.0-1.2.3.255') == ip_range('1.2.3.0', '1.2.3.255')
+    assert parse_blocklist_line('desc:2001:db8::-2001:db8::ff') == ip_range('2001:db8::', '2001:db8::ff')
+    assert parse_blocklist_line('2001:db8::-2001:db8::ff') == ip_range('2001:db8::', '2001:db8::ff')
+    assert parse_blocklist_line('1.2.3.0-1.2.3.255') == ip_range('1.2.3.0', '1.2.3.255')
+
+    # ipfilter.dat, zero padded octets and an access level
+    assert parse_blocklist_line('001.002.003.000 - 001.002.003.255 , 000 , Bad Corp') == ip_range('1.2.3.0', '1.2.3.255')
+    assert parse_blocklist_line('001.002.003.000 - 001.002.003.255 , 100 , Bad: Corp, Inc') == ip_range('1.2.3.0', '1.2.3.255')
+    assert parse_blocklist_line('001.002.003.000 - 001.002.003.255 , 200 , Allowed Corp') is None
+
+    # cidr / single ips, comments and garbage
+    assert parse_blocklist_line('1.2.3.0/24') == ip_range('1.2.3.0', '1.2.3.255')
+    assert parse_blocklist_line('2001:db8::/120') == ip_range('2001:db8::', '2001:db8::ff')
+    assert parse_blocklist_line('1.2.3.4') == ip_range('1.2.3.4', '1.2.3.4')
+    assert parse_blocklist_line('# 1.2.3.0-1.2.3.255') is None
+    assert parse_blocklist_line('not a range') is None
+    assert parse_blocklist_line('desc:1.2.3.0-2001:db8::') is None
+
+    ip_filter = IPFilter()
+    ip_filter.set_ranges([ip_range('1.2.3.0', '1.2.3.255'), ip_range('2001:db8::', '2001:db8::ff')])
+    assert '1.2.3.4' in ip_filter and '::ffff:1.2.3.4' in ip_filter and '2001:db8::1' in ip_filter
+    assert '1.2.4.0' not in ip_filter and '2001:db8::100' not in ip_filter
+    print('ok')
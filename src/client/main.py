@@ -38,7 +38,15 @@ if __name__ == '__main__':
     download_thread = threading.Thread(target=lambda: asyncio.run(session.download()), daemon=True)
     download_thread.start()
 
-    download_thread.join()
+    try:
+        while download_thread.is_alive():
+            download_thread.join(10)
+            if download_thread.is_alive():
+                print(f'{session.state} disk: {session.disk_metrics}')
+    except KeyboardInterrupt:
+        # keep the progress, the next start will skip rehashing unchanged files
+        session.save_resume_data()
+        raise
     print('download complete!')
     seeding_thread.join()
 
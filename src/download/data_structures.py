@@ -2,6 +2,7 @@ from src.peer.message_types import BLOCK_SIZE
 
 from typing import List, Tuple, Any, Set
 from dataclasses import dataclass
+from hashlib import sha1
 from random import random
 
 # block states
@@ -42,6 +43,7 @@ class Block(object):
             self.state = FINISHED
             self.downloaded_from = address[0]
             self.piece.current_block += 1
+            self.piece.advance_hash()
             return True
         return False
 
@@ -82,11 +84,28 @@ class DownloadingPiece(object):
         self.urgent = False  # true if the piece needs to be completed as fast as possible due to a failed request
         self.previous_tries: List[FailedPiece] = []
 
+        # running hash of the blocks received in order, verification is almost free when the last block lands
+        self.hasher = sha1()
+        self.hashed_blocks = 0
+
     def reset(self):
         self.all_requested = False
         self.current_block = 0
         for block in self.blocks:
             block.reset()
+        self.hasher = sha1()
+        self.hashed_blocks = 0
+
+    def advance_hash(self):
+        # feed every contiguous block from the start of the piece that is not hashed yet
+        while self.hashed_blocks < self.blocks_length and self.blocks[self.hashed_blocks].data is not None:
+            self.hasher.update(self.blocks[self.hashed_blocks].data)
+            self.hashed_blocks += 1
+
+    def digest(self) -> bytes:
+        # blocks that arrived out of order are hashed here, at completion
+        self.advance_hash()
+        return self.hasher.digest()
 
     def get_next_request(self):
         if self.all_requested:
@@ -143,7 +162,7 @@ class FailedPiece(object):
 
         bad_peers = set()
         for good_block, bad_block in zip(verified_blocks, self.failed_blocks):
-            if good_block[0] == bad_block[0]:
+            if good_block[0] == bad_block[0] or bad_block[1] is None:
                 continue
 
             # bad peer detected!
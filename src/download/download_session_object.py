@@ -1,19 +1,23 @@
 import src.app_data.db_utils as db_utils
 from src.torrent.torrent import read_torrent
-from src.tracker.announce import initial_announce
+from src.tracker.announce import Announcer
 from src.tracker.utils import format_peers_list
-from src.geoip.utils import get_my_public_ip
+from src.geoip.utils import get_my_public_ip, get_info
 from src.download.piece_picker import PiecePicker
 from src.peer.peer_communication import tcp_wire_communication
 from src.file.file_object import File
 from src.download.upload_in_download import TitForTat
 from src.tracker.tracker_object import Tracker
+from src.tracker.http_tracker import close_session
+from src.tracker.udp_tracker import close_endpoints
+from src.file.resume_data import load_resume_data, save_resume_data, resume_data_loop
+from src.seeding.acceptor import ACCEPTOR
 
 import threading
 import asyncio
 from hashlib import sha1
 import bitstring
-from typing import List, Tuple
+from typing import Dict, List, Tuple, Union
 
 
 class DownloadSession(object):
@@ -28,15 +32,46 @@ class DownloadSession(object):
         self.wasted = 0
         self.state = None
 
+        self.resume_data = None  # fast-resume record found while verifying
+        self.file = None
+        self.piece_picker = None
+        self.announcer = None
+
     @staticmethod
-    async def work_wrapper(disk_loop, tit_for_tat_loop, *work):
+    async def work_wrapper(info_hash: bytes, inbound_handler, disk_loop, tit_for_tat_loop, resume_loop, dial_peers):
+        """
+        :param dial_peers: coroutine that connects to the swarm, returns False if no peers were found
+        """
         tit_for_tat_loop = asyncio.create_task(tit_for_tat_loop())
-        disk_loop = await asyncio.to_thread(disk_loop)
+        # hashing and writing run in the disk pools, the loop itself only dispatches pieces
+        disk_loop = asyncio.create_task(disk_loop())
 
-        await asyncio.gather(tit_for_tat_loop, disk_loop, *work)
+        # peers that connect to the seeding server for this torrent are handed to this loop
+        ACCEPTOR.register(info_hash, asyncio.get_running_loop(), inbound_handler)
+        loops = asyncio.gather(tit_for_tat_loop, disk_loop, resume_loop)
+        try:
+            # the loops run until the download completes. a download that found no peers stops them
+            if not await dial_peers:
+                loops.cancel()
+                await asyncio.gather(loops, return_exceptions=True)
+                return
+            await loops
+        finally:
+            ACCEPTOR.unregister(info_hash)
+            # the trackers are announced to from this loop as well
+            await close_session()
+            close_endpoints()
 
     async def download(self) -> bool:
         # should be called from protected code
+        try:
+            return await self.__download()
+        finally:
+            # the trackers' connections live as long as this loop
+            await close_session()
+            close_endpoints()
+
+    async def __download(self) -> bool:
 
         # read torrent file
         self.state = 'Reading torrent'
@@ -60,43 +95,64 @@ class DownloadSession(object):
         # add the torrent file path for fail safety
         db_utils.add_ongoing_torrent(self.torrent_path)
 
-        # initial announce
         self.state = 'Announcing'
-        peers_list, tracker_list = await initial_announce(self.TorrentData, self.downloaded, self.uploaded, self.left, db_utils.get_configuration('v4_forward')['external_port'], 2)
-        # format peer list: sort and remove unwanted peers
+        self.announcer = Announcer(self.TorrentData)
         my_ip = await get_my_public_ip()
-        peers_list = format_peers_list(peers_list, my_ip)
-
-        if not peers_list:
-            self.state = 'Failed'
-            print("couldn't find any peers!")
-            return False
-
-        # --------
-        # peer wire protocol
-        self.state = 'Downloading...'
 
-        piece_picker = PiecePicker(self.TorrentData, bitarray, missing)
+        piece_picker = PiecePicker(self.TorrentData, bitarray, missing, db_utils.get_configuration('max_queued_pieces'))
+        if self.resume_data is not None:
+            piece_picker.restore_partial_pieces(self.resume_data.partial_pieces)
         tit_for_tat_manager = TitForTat(piece_picker)
 
         # start disk IO thread
         await db_utils.set_configuration('download_dir', self.result_dir)
-        file = File(self.TorrentData, piece_picker, piece_picker.results_queue, self.torrent_path, self.result_dir, False)
+        try:
+            file = File(self.TorrentData, piece_picker, piece_picker.results_queue, self.torrent_path, self.result_dir, False, db_utils.get_configuration('storage_allocation'))
+        except OSError as e:
+            self.state = 'Failed'
+            print(e)
+            return False
+        self.file, self.piece_picker = file, piece_picker
+
+        async def inbound_handler(sock, address: Tuple[str, int], peer_id: bytes):
+            reader, writer = await asyncio.open_connection(sock=sock)
+            peer = address, get_info(address[0]), None
+            await tcp_wire_communication(peer, self.TorrentData, file, piece_picker, tit_for_tat_manager, (reader, writer, peer_id))
+
+        async def dial_peers():
+            # initial announce, the peers of every tracker are dialed as soon as it answers
+            connections = []
+            async for peers in self.announcer.announce(self.downloaded, self.uploaded, self.left, 2):
+                # format peer list: sort and remove unwanted peers
+                peers = format_peers_list(peers, my_ip)
+                if peers:
+                    self.state = 'Downloading...'
+                for peer in peers:
+                    connections.append(asyncio.create_task(tcp_wire_communication(peer, self.TorrentData, file, piece_picker, tit_for_tat_manager)))
+
+            if not connections:
+                self.state = 'Failed'
+                print("couldn't find any peers!")
+                return False
+            await asyncio.gather(*connections)
+            return True
 
-        work = [tcp_wire_communication(peer, self.TorrentData, file, piece_picker, tit_for_tat_manager) for peer in peers_list]
+        resume_loop = resume_data_loop(file, piece_picker, db_utils.get_configuration('resume_data_interval'))
         try:
-            thread = threading.Thread(target=lambda: asyncio.run(DownloadSession.work_wrapper(file.save_pieces_loop, tit_for_tat_manager.loop, *work)), daemon=True)
+            thread = threading.Thread(target=lambda: asyncio.run(DownloadSession.work_wrapper(self.TorrentData.info_hash, inbound_handler, file.save_pieces_loop, tit_for_tat_manager.loop, resume_loop, dial_peers())), daemon=True)
             thread.start()
             thread.join()
         except RuntimeError:
             pass
 
+        self.save_resume_data()
+
         if db_utils.CompletedTorrentsDB().find_info_hash(self.TorrentData.info_hash):
             # announce completion
             # TODO turn torrent statistics to self statistics
             total_download, total_upload = self.TorrentData.downloaded + self.TorrentData.corrupted + self.TorrentData.wasted, self.TorrentData.uploaded
             # TODO use the tracker update thread to announce complete
-            for tracker in tracker_list:
+            for tracker in self.announcer.trackers:
                 if tracker.state == 'working':
                     await tracker.re_announce(total_download, total_upload, 0, 1)
 
@@ -106,9 +162,26 @@ class DownloadSession(object):
             return False
 
         self.state = 'Completed'
-        print(tracker_list)
+        print(self.announcer.trackers)
         return True
 
+    @property
+    def disk_metrics(self) -> Union[Dict[str, int], None]:
+        """
+        :return: depth of the completed pieces queue (current, limit, peak) and the disk pools' counters,
+        None before the download started
+        """
+        if self.file is None:
+            return None
+        return self.file.disk_metrics()
+
+    def save_resume_data(self):
+        """
+        writes the fast-resume record of the download, call at shutdown
+        """
+        if self.file is not None and self.piece_picker is not None:
+            save_resume_data(self.file, self.piece_picker)
+
     def verify_torrent(self) -> Tuple[bitstring.BitArray, List[int]]:
         # do not re-download existing torrent pieces!
         missing = None
@@ -116,10 +189,19 @@ class DownloadSession(object):
         if self.torrent_path in db_utils.get_ongoing_torrents() or db_utils.CompletedTorrentsDB().find_info_hash(self.TorrentData.info_hash):
             temp_file = None
             try:
-                bitarray = bitstring.BitArray(bin='1' * len(self.TorrentData.piece_hashes))
-                missing = []
                 temp_file = File(self.TorrentData, None, None, None, self.result_dir)
-                for index, torrent_piece_hash in enumerate(self.TorrentData.piece_hashes):
+
+                # trust the fast-resume record, rehash only pieces of files that changed since it was saved
+                self.resume_data = load_resume_data(self.TorrentData.info_hash, len(self.TorrentData.piece_hashes))
+                if self.resume_data is not None:
+                    bitarray = self.resume_data.have_pieces
+                    recheck = self.resume_data.pieces_to_recheck(temp_file.file_names, temp_file.file_indices, self.TorrentData.info[b'piece length'])
+                else:
+                    bitarray = bitstring.BitArray(bin='1' * len(self.TorrentData.piece_hashes))
+                    recheck = range(len(self.TorrentData.piece_hashes))
+
+                for index in recheck:
+                    torrent_piece_hash = self.TorrentData.piece_hashes[index]
                     # hash check
                     if index != len(self.TorrentData.piece_hashes) - 1:
                         data = temp_file.get_piece(index, 0, self.TorrentData.info[b'piece length'])
@@ -128,11 +210,13 @@ class DownloadSession(object):
                         data = temp_file.get_piece(index, 0, self.TorrentData.info[b'piece length'] - extra)
 
                     piece_hash = sha1(data[2]).digest()
-                    if torrent_piece_hash != piece_hash:
-                        bitarray[index] = False
-                        missing.append(index)
+                    bitarray[index] = torrent_piece_hash == piece_hash
+
+                missing = [index for index, bit in enumerate(bitarray) if not bit]
             except OSError:
                 bitarray = bitstring.BitArray(bin='0' * len(self.TorrentData.piece_hashes))
+                missing = None
+                self.resume_data = None
             finally:
                 del temp_file
 
@@ -18,16 +18,27 @@ class BetterQueue(asyncio.Queue):
     def __init__(self, maxsize: int = 0):
         super().__init__(maxsize)
         self.size = 0
+        self.peak_size = 0
+        self.not_full = asyncio.Event()
+        self.not_full.set()
 
-    async def put(self, item):
-        await super().put(item)
+    def put_nowait(self, item):
+        # asyncio.Queue.put() and get() end with put_nowait() and get_nowait(), count items only here
+        super().put_nowait(item)
         self.size += 1
+        self.peak_size = max(self.peak_size, self.size)
+        if self.full():
+            self.not_full.clear()
 
-    async def get(self):
-        item = await super().get()
+    def get_nowait(self):
+        item = super().get_nowait()
         self.size -= 1
+        self.not_full.set()
         return item
 
+    async def wait_not_full(self):
+        await self.not_full.wait()
+
 
 @dataclass
 class PiecePos(object):
@@ -77,9 +88,9 @@ class PriorityBucket(object):
 class PiecePicker(object):
     FILE_STATUS: bitstring.bitarray
 
-    def __init__(self, TorrentData: Torrent, bitarray: bitstring.bitarray, index_range: List[int] = None) -> None:
+    def __init__(self, TorrentData: Torrent, bitarray: bitstring.bitarray, index_range: List[int] = None, max_queued_pieces: int = 0) -> None:
         self.TorrentData = TorrentData
-        self.results_queue = BetterQueue()
+        self.results_queue = BetterQueue(max_queued_pieces)  # completed pieces waiting for the disk
         PiecePicker.FILE_STATUS = bitarray
 
         self.is_in_endgame = False
@@ -111,6 +122,8 @@ class PiecePicker(object):
     async def get_block(self, have_mask: bitstring.bitarray) -> Block:
         if self.is_in_endgame:
             return None
+        # backpressure: don't request more blocks while the disk is behind
+        await self.results_queue.wait_not_full()
         async with asyncio.Lock():
             # search the downloading pieces first
             for index, piece in self.downloading.items():
@@ -128,15 +141,7 @@ class PiecePicker(object):
                     if have_mask[piece.piece_index]:
                         bucket.remove(piece)
 
-                        newPiece = DownloadingPiece(piece.piece_index, self.TorrentData.info[b'piece length'])
-                        # remove excessive blocks from the last piece
-                        if piece.piece_index == len(self.TorrentData.piece_hashes) - 1:
-                            extra = len(self.TorrentData.piece_hashes) * self.TorrentData.info[b'piece length'] - self.TorrentData.length
-                            while extra > BLOCK_SIZE:
-                                extra -= BLOCK_SIZE
-                                newPiece.blocks.pop()
-                                newPiece.blocks_length -= 1
-                            newPiece.blocks[-1].length -= extra
+                        newPiece = self.new_downloading_piece(piece.piece_index)
 
                         # transfer the piece to downloading dict
                         self.downloading[piece.piece_index] = newPiece
@@ -154,6 +159,52 @@ class PiecePicker(object):
                 self.endgame()
             return None
 
+    def new_downloading_piece(self, piece_index: int) -> DownloadingPiece:
+        newPiece = DownloadingPiece(piece_index, self.TorrentData.info[b'piece length'])
+        # remove excessive blocks from the last piece
+        if piece_index == len(self.TorrentData.piece_hashes) - 1:
+            extra = len(self.TorrentData.piece_hashes) * self.TorrentData.info[b'piece length'] - self.TorrentData.length
+            while extra > BLOCK_SIZE:
+                extra -= BLOCK_SIZE
+                newPiece.blocks.pop()
+                newPiece.blocks_length -= 1
+            newPiece.blocks[-1].length -= extra
+        return newPiece
+
+    def restore_partial_pieces(self, partial_pieces: Dict[int, List[Tuple[int, bytes]]]):
+        """
+        re-adds blocks of unfinished pieces from a fast-resume record
+        must be called before the download starts
+        :param partial_pieces: piece index -> [(begin, data), ...]
+        """
+        for piece_index, blocks in partial_pieces.items():
+            if piece_index not in self.pieces_map or PiecePicker.FILE_STATUS[piece_index]:
+                continue
+
+            piece = self.new_downloading_piece(piece_index)
+            for begin, data in blocks:
+                for block in piece.blocks:
+                    if block.is_equal(piece_index, begin, len(data)):
+                        # no sender address, restored blocks are never blamed for a hash failure
+                        block.data = data
+                        block.state = FINISHED
+                        piece.current_block += 1
+                        break
+
+            if piece.current_block == 0:
+                continue
+            piece.advance_hash()
+
+            self.buckets_dict[0].remove(self.pieces_map[piece_index])
+            self.downloading[piece_index] = piece
+            if piece.is_completed:
+                self.downloading.pop(piece_index)
+                try:
+                    self.results_queue.put_nowait(piece)
+                except asyncio.QueueFull:
+                    piece.reset()
+                    self.downloading[piece_index] = piece
+
     async def report_block(self, block: Block, add_data_args: Tuple[bytes, Tuple[str, int]]):
         async with asyncio.Lock():
             # the stream already verified the block and made sure we requested it
@@ -0,0 +1,69 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple, Dict, Any, Callable
+import asyncio
+
+
+def hash_piece(piece) -> Tuple[bytes, bytes]:
+    """
+    finishes the running hash of a completed piece and joins its blocks
+    note: runs in the hashing pool, only blocks that arrived out of order are still hashed here
+    :return: sha1 digest, piece data
+    """
+    return piece.digest(), piece.get_data
+
+
+class DiskIO(object):
+    """
+    disk subsystem of a download
+    completed pieces are hashed in a worker pool and verified pieces are written by a dedicated I/O pool,
+    the event loop only awaits the results. the number of pieces in flight is limited by the workers,
+    the rest wait in the bounded results queue of the piece picker
+    """
+
+    def __init__(self, hash_threads: int = 2, io_threads: int = 1):
+        self.hash_pool = ThreadPoolExecutor(hash_threads, thread_name_prefix='RaBit-hash')
+        self.io_pool = ThreadPoolExecutor(io_threads, thread_name_prefix='RaBit-io')
+        self.slots = asyncio.Semaphore(hash_threads + io_threads)  # pieces taken out of the queue
+
+        # statistics
+        self.hashing = 0  # pieces being hashed
+        self.writing = 0  # pieces being written
+        self.pieces_hashed = 0
+        self.pieces_written = 0
+        self.bytes_written = 0
+
+    async def run_hash(self, func: Callable, *args) -> Any:
+        self.hashing += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.hash_pool, func, *args)
+        finally:
+            self.hashing -= 1
+            self.pieces_hashed += 1
+
+    async def run_write(self, func: Callable, *args) -> Any:
+        self.writing += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.io_pool, func, *args)
+        finally:
+            self.writing -= 1
+            self.pieces_written += 1
+
+    def metrics(self, results_queue) -> Dict[str, int]:
+        """
+        :param results_queue: the bounded queue of completed pieces
+        :return: queue depth and in-flight counters
+        """
+        return {
+            'queued': results_queue.qsize(),
+            'queue_limit': results_queue.maxsize,
+            'peak_queued': results_queue.peak_size,
+            'hashing': self.hashing,
+            'writing': self.writing,
+            'pieces_hashed': self.pieces_hashed,
+            'pieces_written': self.pieces_written,
+            'bytes_written': self.bytes_written
+        }
+
+    def shutdown(self):
+        self.hash_pool.shutdown(wait=False)
+        self.io_pool.shutdown(wait=False)
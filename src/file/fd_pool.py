@@ -0,0 +1,87 @@
+import src.app_data.db_utils as db_utils
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Tuple, List, Iterable, Iterator
+import threading
+import os
+
+
+O_BINARY = getattr(os, 'O_BINARY', 0)  # windows only
+_DEFAULT_MAX_OPEN_FILES = 512
+
+
+class FilePool(object):
+    """
+    process-wide LRU cache of open file descriptors, keyed by (path, flags)
+    files are opened lazily on first access and shared by every reader and writer.
+    descriptors in use are refcounted and never closed under their users,
+    idle ones are closed (least recently used first) when the limit is reached
+    """
+
+    def __init__(self, max_open_files: int = None):
+        self._max_open_files = max_open_files
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[Tuple[str, int], List[int]] = OrderedDict()  # (path, flags) -> [fd, refcount]
+
+    @property
+    def max_open_files(self) -> int:
+        if self._max_open_files is None:  # read lazily, the configuration may not be importable yet
+            self._max_open_files = db_utils.get_configuration('max_open_files') or _DEFAULT_MAX_OPEN_FILES
+        return self._max_open_files
+
+    def acquire(self, path: str, flags: int) -> int:
+        key = (path, flags)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.__evict(self.max_open_files - 1)
+                entry = [os.open(path, flags | O_BINARY), 0]
+                self.entries[key] = entry
+            else:
+                self.entries.move_to_end(key)
+            entry[1] += 1
+            return entry[0]
+
+    def release(self, path: str, flags: int):
+        with self.lock:
+            entry = self.entries.get((path, flags))
+            if entry is not None:
+                entry[1] -= 1
+                if len(self.entries) > self.max_open_files:
+                    self.__evict(self.max_open_files)
+
+    @contextmanager
+    def open(self, path: str, flags: int) -> Iterator[int]:
+        fd = self.acquire(path, flags)
+        try:
+            yield fd
+        finally:
+            self.release(path, flags)
+
+    def forget(self, paths: Iterable[str]):
+        """
+        closes the idle descriptors of these files, used ones are closed later by the LRU
+        """
+        paths = set(paths)
+        with self.lock:
+            for key in [key for key, entry in self.entries.items() if key[0] in paths and entry[1] == 0]:
+                os.close(self.entries.pop(key)[0])
+
+    @property
+    def open_files(self) -> int:
+        return len(self.entries)
+
+    def __evict(self, limit: int):
+        # called with the lock held
+        while len(self.entries) > limit:
+            for key, entry in self.entries.items():  # least recently used first
+                if entry[1] == 0:
+                    os.close(entry[0])
+                    del self.entries[key]
+                    break
+            else:  # every descriptor is in use, go over the limit
+                return
+
+
+FILE_POOL = FilePool()
@@ -1,17 +1,102 @@
 import src.app_data.db_utils as db_utils
+import src.file.resume_data as resume_data
 from src.download.data_structures import DownloadingPiece, FailedPiece
 from src.download.piece_picker import BetterQueue, PiecePicker
 from src.peer.peer_object import Peer
 from src.torrent.torrent_object import Torrent
+from src.peer.message_types import MAX_REQUEST_LENGTH
+from .disk_io import DiskIO, hash_piece
+from .fd_pool import FILE_POOL, O_BINARY
 
 import asyncio
-from hashlib import sha1
-from typing import Tuple
+from typing import Tuple, Dict, List, Iterator, Set
+from functools import partial
+from bisect import bisect_right
 import threading
+import shutil
+import errno
 import os
 import re
 
 
+# storage allocation policies
+SPARSE = 'sparse'  # files get their final length at once, blocks are allocated by the filesystem on write
+FULL = 'full'  # all blocks are reserved before the download starts
+LAZY = 'lazy'  # all blocks of a file are reserved on its first write
+
+_SEEK_LOCK = threading.Lock()  # guards lseek + read/write where positional I/O is not available
+
+
+def read_at(fd: int, length: int, offset: int) -> bytes:
+    if hasattr(os, 'pread'):
+        return os.pread(fd, length, offset)
+    with _SEEK_LOCK:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, length)
+
+
+def write_at(fd: int, data: memoryview, offset: int):
+    # os.write may write less than asked, loop until everything is on disk
+    while data:
+        if hasattr(os, 'pwrite'):
+            written = os.pwrite(fd, data, offset)
+        else:
+            with _SEEK_LOCK:
+                os.lseek(fd, offset, os.SEEK_SET)
+                written = os.write(fd, data)
+        data = data[written:]
+        offset += written
+
+
+def file_spans(file_indices: List[int], abs_begin: int, length: int) -> Iterator[Tuple[int, int, int]]:
+    """
+    maps a range of the torrent onto the files it covers
+    :param file_indices: cumulative end offsets of the files
+    :param abs_begin: offset of the range from the beginning of the torrent
+    :param length: length of the range
+    :return: generator of (file index, offset inside the file, length inside the file)
+    """
+    index = bisect_right(file_indices, abs_begin)
+    while length > 0 and index < len(file_indices):
+        file_begin = file_indices[index - 1] if index > 0 else 0
+        span = min(length, file_indices[index] - abs_begin)
+        if span > 0:  # empty files have nothing to read or write
+            yield index, abs_begin - file_begin, span
+
+        abs_begin += span
+        length -= span
+        index += 1
+
+
+def allocated_size(file_name: str) -> int:
+    """
+    :return: bytes the filesystem already reserved for the file, 0 if it does not exist
+    """
+    try:
+        stat = os.stat(file_name)
+    except OSError:
+        return 0
+    if hasattr(stat, 'st_blocks'):
+        return min(stat.st_blocks * 512, stat.st_size)
+    return stat.st_size
+
+
+def allocate_file(fd: int, size: int, reserve: bool):
+    """
+    gives a file its final length before pieces are written at arbitrary offsets
+    files that already have it are left untouched, their mtime is part of the fast-resume record
+    :param fd: file descriptor opened for writing
+    :param size: final size of the file
+    :param reserve: reserve all the blocks (contiguous layout) instead of leaving the file sparse
+    """
+    stat = os.fstat(fd)
+    if reserve and hasattr(os, 'posix_fallocate'):
+        if stat.st_size < size or stat.st_blocks * 512 < size:
+            os.posix_fallocate(fd, 0, size)
+    elif stat.st_size < size:
+        os.ftruncate(fd, size)
+
+
 def format_file_name(file_name: str) -> str:
     # remove illegal name chars
     file_name = re.sub(r'[<>:"/\\|?*]', '', file_name)
@@ -26,12 +111,17 @@ def format_file_name(file_name: str) -> str:
 
 
 class File(object):
-    def __init__(self, TorrentData: Torrent, piece_picker: PiecePicker, results_queue: BetterQueue, torrent_path: str, path: str, skip_hash_check: bool = False):
+    def __init__(self, TorrentData: Torrent, piece_picker: PiecePicker, results_queue: BetterQueue, torrent_path: str, path: str, skip_hash_check: bool = False, allocation: str = None):
+        """
+        :param allocation: storage allocation policy (sparse, full or lazy) | None to leave the files as they are
+        """
         self.TorrentData = TorrentData
         self.results_queue = results_queue
         self.skip_hash_check = skip_hash_check
         self.piece_picker = piece_picker
         self.torrent_path = torrent_path
+        self.path = path
+        self.allocation = allocation
 
         if not TorrentData.multi_file:
             self.file_names = [os.path.join(path, format_file_name(TorrentData.info[b'name'].decode('utf-8')))]
@@ -56,122 +146,149 @@ class File(object):
                     os.makedirs(file_name, exist_ok=True)
                 self.file_names.append(file_name)
 
-        self.fds = [os.open(file_name, os.O_RDWR | os.O_CREAT | os.O_BINARY) for file_name in self.file_names]
+        if self.allocation is not None:
+            self.check_free_space()
+
+        # files are opened lazily through the file pool
+        self.flags = os.O_RDWR | os.O_CREAT
+
+        self.allocated: List[bool] = [self.allocation is None] * len(self.file_names)
+        for index, file_name in enumerate(self.file_names):
+            if self.allocation in (SPARSE, FULL):
+                self.allocate(index)
+            else:  # create the file without keeping it open
+                os.close(os.open(file_name, self.flags | O_BINARY))
 
-    def reopen_files(self):
+        self.disk_io = DiskIO(db_utils.get_configuration('disk_hash_threads'), db_utils.get_configuration('disk_io_threads'))
+        self.saving_tasks: Set[asyncio.Task] = set()  # referenced until done, or the loop may collect them
+
+    @property
+    def file_sizes(self) -> List[int]:
+        return [indice - (self.file_indices[index - 1] if index > 0 else 0) for index, indice in enumerate(self.file_indices)]
+
+    def check_free_space(self):
         """
-        reopens completed files in read-only mode
-        :return: None
+        makes sure the download fits on the disk before it starts instead of failing in the middle
+        :raise OSError: ENOSPC if the missing bytes are more than the free space
         """
-        self.fds = [os.open(file_name, os.O_RDONLY | os.O_BINARY) for file_name in self.file_names]
-
-    def close_files(self):
-        for fd in self.fds:
-            os.close(fd)
-        self.fds = []
+        required = sum(max(0, size - allocated_size(file_name)) for file_name, size in zip(self.file_names, self.file_sizes))
+        free = shutil.disk_usage(os.path.dirname(self.file_names[0]) or '.').free
+        if required > free:
+            raise OSError(errno.ENOSPC, f'not enough disk space: {required} bytes required, {free} bytes free', self.path)
 
-    def get_piece(self, piece_index: int, begin: int, length: int) -> Tuple[int, int, bytes]:
-        reading_begin_index = self.TorrentData.info[b'piece length'] * piece_index + begin
-        remaining_length = length
-        current_piece_abs_index = reading_begin_index
-        first = True
-        data = b''
-        for index, indice in enumerate(self.file_indices):
-            if reading_begin_index >= indice:
-                continue
+    def allocate(self, index: int):
+        with FILE_POOL.open(self.file_names[index], self.flags) as fd:
+            allocate_file(fd, self.file_sizes[index], self.allocation != SPARSE)
+        self.allocated[index] = True
 
-            len_for_indice = min(remaining_length, indice - current_piece_abs_index)
+    @property
+    def disk_metrics(self) -> Dict[str, int]:
+        return self.disk_io.metrics(self.results_queue)
 
-            relative_file_begin = 0 if not first else current_piece_abs_index - self.file_indices[index - 1] if index > 0 else current_piece_abs_index
+    def close_files(self):
+        FILE_POOL.forget(self.file_names)
 
-            os.lseek(self.fds[index], relative_file_begin, os.SEEK_SET)
-            data += os.read(self.fds[index], len_for_indice)
+    def read_span(self, index: int, offset: int, span: int) -> bytes:
+        with FILE_POOL.open(self.file_names[index], self.flags) as fd:
+            return read_at(fd, span, offset)
 
-            remaining_length -= len_for_indice
-            current_piece_abs_index += len_for_indice
-            first = False
-            if remaining_length == 0:
-                break
+    def get_piece(self, piece_index: int, begin: int, length: int) -> Tuple[int, int, bytes]:
+        reading_begin_index = self.TorrentData.info[b'piece length'] * piece_index + begin
+        data = b''.join([self.read_span(*span) for span in file_spans(self.file_indices, reading_begin_index, length)])
 
         if len(data) < length:  # add padding to the last piece
             data += b'\x00' * (length - len(data))
 
         return piece_index, begin, data
 
+    def write_piece(self, piece_index: int, data: bytes):
+        """
+        writes a verified piece to the files it spans
+        note: blocking function! runs in the disk I/O pool
+        """
+        piece_abs_index = self.TorrentData.info[b'piece length'] * piece_index
+        data = memoryview(data)
+
+        piece_relative_begin = 0
+        for index, offset, span in file_spans(self.file_indices, piece_abs_index, len(data)):
+            if not self.allocated[index]:  # lazy allocation
+                self.allocate(index)
+            with FILE_POOL.open(self.file_names[index], self.flags) as fd:
+                write_at(fd, data[piece_relative_begin:piece_relative_begin + span], offset)
+            piece_relative_begin += span
+
     async def save_pieces_loop(self):
+        # pipeline: take a piece only when a worker is free, so the bounded queue fills up and slows the requests
         while True:
-            if self.piece_picker.num_of_pieces_left == 0:
-                # TODO a more elegant exit, let all interested disconnect and then switch to seeding in seeding server
-                self.close_files()
-                # add to completed torrents db
-                db_utils.CompletedTorrentsDB().insert_torrent(PickableFile(self))
-                db_utils.remove_ongoing_torrent(self.torrent_path)
-                loop = asyncio.get_event_loop()
-                loop.stop()
-
-            with threading.Lock():
-                piece: DownloadingPiece = await self.results_queue.get()
-
-            # hash check
-            data = piece.get_data
-            piece_hash = sha1(data).digest()
-            torrent_piece_hash = self.TorrentData.piece_hashes[piece.index]
-
-            if not self.skip_hash_check:
-                if piece_hash != torrent_piece_hash:
-                    # TODO create corrupt pieces and blocks instances and remember the addresses of senders
-                    print('received corrupted piece ', piece.index)
-
-                    self.TorrentData.corrupted += len(data)
-
-                    piece.previous_tries.append(FailedPiece(piece))
-                    piece.reset()
-                    await self.piece_picker.add_failed_piece(piece)
-
-                    continue
-
-            print("\033[90m{}\033[00m".format(f'got piece. {round((1 - (self.piece_picker.num_of_pieces_left - 1) / len(self.piece_picker.pieces_map)) * 100, 2)}%. have index: {piece.index}. from {len(Peer.peer_instances)} peers.'))
-
-            # ban bad peers if any
-            bad_peers = piece.get_bad_peers()
-            async with asyncio.Lock():
-                database = db_utils.BannedPeersDB()
-                for peer_ip in bad_peers:
-                    database.insert_ip(peer_ip)
-                    peer = list(filter(lambda x: x.address[0] == peer_ip, Peer.peer_instances))[0]
+            await self.disk_io.slots.acquire()
+            piece: DownloadingPiece = await self.results_queue.get()
+
+            task = asyncio.create_task(self.save_piece(piece))
+            self.saving_tasks.add(task)
+            task.add_done_callback(partial(self.__piece_saved, piece))
+
+    def __piece_saved(self, piece: DownloadingPiece, task: asyncio.Task):
+        self.saving_tasks.discard(task)
+        self.disk_io.slots.release()
+        if task.cancelled() or task.exception() is None:
+            return
+
+        # hashing or writing failed (disk full, closed pool...), download the piece again
+        print(f'failed to save piece {piece.index}: {task.exception()!r}')
+        if self.piece_picker.FILE_STATUS[piece.index]:  # it was written, only a later step failed
+            return
+        piece.reset()
+        retry = asyncio.create_task(self.piece_picker.add_failed_piece(piece))
+        self.saving_tasks.add(retry)
+        retry.add_done_callback(self.saving_tasks.discard)
+
+    async def save_piece(self, piece: DownloadingPiece):
+        # hash check
+        piece_hash, data = await self.disk_io.run_hash(hash_piece, piece)
+        torrent_piece_hash = self.TorrentData.piece_hashes[piece.index]
+
+        if not self.skip_hash_check:
+            if piece_hash != torrent_piece_hash:
+                print('received corrupted piece ', piece.index)
+
+                self.TorrentData.corrupted += len(data)
+
+                piece.previous_tries.append(FailedPiece(piece))
+                piece.reset()
+                await self.piece_picker.add_failed_piece(piece)
+                return
+
+        print("\033[90m{}\033[00m".format(f'got piece. {round((1 - (self.piece_picker.num_of_pieces_left - 1) / len(self.piece_picker.pieces_map)) * 100, 2)}%. have index: {piece.index}. from {len(Peer.peer_instances)} peers.'))
+
+        # ban bad peers if any
+        bad_peers = piece.get_bad_peers()
+        async with asyncio.Lock():
+            for peer_ip in bad_peers:
+                db_utils.ban_peer(peer_ip)
+                for peer in filter(lambda x: x.address[0] == peer_ip, Peer.peer_instances):
                     peer.found_dirty = True
-                    print('banned ', peer_ip)
-
-            piece_abs_index = self.TorrentData.info[b'piece length'] * piece.index
-
-            # save to files
-            remaining_length = len(data)
-            current_piece_abs_index = piece_abs_index
-            piece_relative_begin = 0
-            first = True
-            for index, indice in enumerate(self.file_indices):
-                if piece_abs_index >= indice:
-                    continue
+                print('banned ', peer_ip)
 
-                len_for_indice = min(remaining_length, indice - current_piece_abs_index)
-                piece_relative_end = piece_relative_begin + len_for_indice
+        # save to files
+        await self.disk_io.run_write(self.write_piece, piece.index, data)
+        self.disk_io.bytes_written += len(data)
 
-                relative_file_begin = 0 if not first else current_piece_abs_index - self.file_indices[index - 1] if index > 0 else current_piece_abs_index
+        self.piece_picker.num_of_pieces_left -= 1
+        self.piece_picker.FILE_STATUS[piece.index] = True  # update primary bitfield
+        await self.piece_picker.send_have(piece.index)
+        piece.reset()
 
-                os.lseek(self.fds[index], relative_file_begin, os.SEEK_SET)
-                os.write(self.fds[index], data[piece_relative_begin:piece_relative_end])
-
-                piece_relative_begin += len_for_indice
-                remaining_length -= len_for_indice
-                current_piece_abs_index += len_for_indice
-                first = False
-                if remaining_length == 0:
-                    break
-
-            self.piece_picker.num_of_pieces_left -= 1
-            self.piece_picker.FILE_STATUS[piece.index] = True  # update primary bitfield
-            await self.piece_picker.send_have(piece.index)
-            piece.reset()
+        if self.piece_picker.num_of_pieces_left == 0:
+            # TODO a more elegant exit, let all interested disconnect and then switch to seeding in seeding server
+            self.close_files()
+            self.disk_io.shutdown()
+            # add to completed torrents db
+            db_utils.CompletedTorrentsDB().insert_torrent(PickableFile(self))
+            db_utils.remove_ongoing_torrent(self.torrent_path)
+            # a full record, the next start trusts the files instead of rehashing all of them
+            resume_data.save_resume_data(self, self.piece_picker)
+            loop = asyncio.get_event_loop()
+            loop.stop()
 
     def __del__(self):
         try:
@@ -181,6 +298,8 @@ class File(object):
 
 
 class PickableFile(object):
+    flags = os.O_RDONLY  # completed files are only read, through the process-wide file pool
+
     def __init__(self, file_object: File):
         self.info_hash = file_object.TorrentData.info_hash
         self.peer_id = file_object.TorrentData.peer_id
@@ -192,54 +311,31 @@ class PickableFile(object):
         self.uploaded = file_object.TorrentData.uploaded
 
         self.file_names = file_object.file_names
-        self.fds = []
         self.file_indices = file_object.file_indices
 
         del file_object
 
-    def reopen_files(self):
-        """
-        reopens completed files in read-only mode
-        :return: None
-        """
-        self.fds = [os.open(file_name, os.O_RDONLY | os.O_BINARY) for file_name in self.file_names]
-
-    def close_files(self):
-        for fd in self.fds:
-            os.close(fd)
-        self.fds = []
+    def read_span(self, index: int, offset: int, span: int) -> bytes:
+        with FILE_POOL.open(self.file_names[index], self.flags) as fd:
+            return read_at(fd, span, offset)
 
     def get_piece(self, piece_index: int, begin: int, length: int) -> Tuple[int, int, bytes]:
         reading_begin_index = self.piece_length * piece_index + begin
-
-        remaining_length = length
-        current_piece_abs_index = reading_begin_index
-        first = True
-        data = b''
-        for index, indice in enumerate(self.file_indices):
-            if reading_begin_index >= indice:
-                continue
-
-            len_for_indice = min(remaining_length, indice - current_piece_abs_index)
-
-            relative_file_begin = 0 if not first else current_piece_abs_index - self.file_indices[index - 1] if index > 0 else current_piece_abs_index
-
-            os.lseek(self.fds[index], relative_file_begin, os.SEEK_SET)
-            data += os.read(self.fds[index], len_for_indice)
-
-            remaining_length -= len_for_indice
-            current_piece_abs_index += len_for_indice
-            first = False
-            if remaining_length == 0:
-                break
+        data = b''.join([self.read_span(*span) for span in file_spans(self.file_indices, reading_begin_index, length)])
 
         if len(data) < length:  # add padding to the last piece
             data += b'\x00' * (length - len(data))
 
         return piece_index, begin, data
 
-    def __del__(self):
-        try:
-            self.close_files()
-        except OSError:
-            pass
+    def block_spans(self, piece_index: int, begin: int, length: int) -> Iterator[Tuple[int, int, int]]:
+        """
+        locates a block on disk, a block may cross file boundaries
+        :return: generator of (file name, offset inside the file, length inside the file)
+        """
+        for index, offset, span in file_spans(self.file_indices, self.piece_length * piece_index + begin, length):
+            yield self.file_names[index], offset, span
+
+    def is_valid_request(self, piece_index: int, begin: int, length: int) -> bool:
+        abs_begin = self.piece_length * piece_index + begin
+        return 0 <= piece_index < self.num_pieces and 0 < length <= MAX_REQUEST_LENGTH and begin + length <= self.piece_length and abs_begin + length <= self.length
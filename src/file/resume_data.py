@@ -0,0 +1,113 @@
+import src.app_data.db_utils as db_utils
+from src.download.data_structures import FINISHED
+
+import asyncio
+import os
+import bitstring
+from typing import List, Tuple, Dict, Set, Union
+
+
+class ResumeData(object):
+    """
+    fast-resume record of a torrent: which pieces are verified on disk, the metadata
+    of the files when the record was taken and the blocks of unfinished pieces.
+    on restart only pieces touching files that changed since the record are rehashed
+    """
+
+    def __init__(self, info_hash: bytes, bitfield: bitstring.BitArray, files: List[Tuple[str, int, int]], partial_pieces: Dict[int, List[Tuple[int, bytes]]]):
+        self.info_hash = info_hash
+        self.num_pieces = len(bitfield)
+        self.bitfield = bitfield.tobytes()
+        self.files = files  # (file name, size, mtime in ns)
+        self.partial_pieces = partial_pieces  # piece index -> [(begin, data), ...]
+
+    @classmethod
+    def capture(cls, file_object, piece_picker) -> object:
+        """
+        takes a snapshot of a running (or stopped) download
+        note: file metadata is read before the bitfield, so a piece written in between
+        leaves a mismatched mtime behind and gets rehashed instead of trusted
+        :param file_object: File instance of the download
+        :param piece_picker: PiecePicker instance of the download
+        :return: ResumeData
+        """
+        files = [(file_name, *stat_file(file_name)) for file_name in file_object.file_names]
+        bitfield = piece_picker.FILE_STATUS[:]
+
+        partial_pieces = dict()
+        for index, piece in list(piece_picker.downloading.items()):
+            if bitfield[index]:
+                continue
+            blocks = [(block.begin, block.data) for block in piece.blocks if block.state == FINISHED]
+            if blocks:
+                partial_pieces[index] = blocks
+
+        return cls(file_object.TorrentData.info_hash, bitfield, files, partial_pieces)
+
+    @property
+    def have_pieces(self) -> bitstring.BitArray:
+        return bitstring.BitArray(bytes=self.bitfield)[:self.num_pieces]
+
+    def mismatched_files(self, file_names: List[str]) -> Set[int]:
+        """
+        cheap validation of the record against the files on disk
+        :param file_names: file names of the torrent, in torrent order
+        :return: indices of files that changed since the record was taken
+        """
+        if len(file_names) != len(self.files):
+            return set(range(len(file_names)))
+
+        mismatched = set()
+        for index, (file_name, record) in enumerate(zip(file_names, self.files)):
+            if file_name != record[0] or stat_file(file_name) != record[1:]:
+                mismatched.add(index)
+        return mismatched
+
+    def pieces_to_recheck(self, file_names: List[str], file_indices: List[int], piece_length: int) -> List[int]:
+        """
+        :return: sorted indices of pieces touching at least one mismatched file
+        """
+        pieces = set()
+        for index in self.mismatched_files(file_names):
+            file_begin = file_indices[index - 1] if index > 0 else 0
+            file_end = file_indices[index]
+            if file_end > file_begin:
+                pieces.update(range(file_begin // piece_length, (file_end - 1) // piece_length + 1))
+        return sorted(pieces)
+
+
+def stat_file(file_name: str) -> Tuple[int, int]:
+    """
+    :return: size and mtime (ns) of a file | (-1, -1) if it does not exist
+    """
+    try:
+        stat = os.stat(file_name)
+        return stat.st_size, stat.st_mtime_ns
+    except OSError:
+        return -1, -1
+
+
+def save_resume_data(file_object, piece_picker) -> None:
+    """
+    writes the fast-resume record of a download
+    note: blocking function!
+    """
+    db_utils.ResumeDataDB().insert_record(ResumeData.capture(file_object, piece_picker))
+
+
+def load_resume_data(info_hash: bytes, num_pieces: int) -> Union[ResumeData, None]:
+    record = db_utils.ResumeDataDB().get_record(info_hash)
+    if record is None or record.num_pieces != num_pieces:
+        return None
+    return record
+
+
+async def resume_data_loop(file_object, piece_picker, interval: float):
+    """
+    periodically saves the fast-resume record while downloading
+    """
+    while True:
+        await asyncio.sleep(interval)
+        record = ResumeData.capture(file_object, piece_picker)
+        # pickling the partial blocks and committing may be slow, keep it off the event loop
+        await asyncio.to_thread(lambda: db_utils.ResumeDataDB().insert_record(record))
@@ -1,13 +1,22 @@
 import src.app_data.db_utils as db_utils
+from src.peer.canonical_priority import set_external_ip
 
 from geoip2 import database, errors
 from math import radians, cos, sin, atan2, sqrt
-from typing import Tuple, Union
+from functools import lru_cache
+from typing import Tuple, Union, List, Iterable
+import threading
+import socket
 import requests
+import numpy
+import time
+import os
 from pathlib import Path
 
 
 __database_path = 'GeoLite2-City.mmdb'
+_CACHE_SIZE = 2 ** 16  # networks kept in the lookup cache
+_RELOAD_CHECK_INTERVAL = 60  # seconds between checks for an updated database
 
 
 def abs_db_path(file_name: str) -> Path:
@@ -39,6 +48,19 @@ def __calc_haversine(lat1: float, long1: float, lat2: float, long2: float) -> fl
     return d
 
 
+def calc_haversine_many(lat: numpy.ndarray, long: numpy.ndarray, lat0: float, long0: float) -> numpy.ndarray:
+    """
+    calculate the haversine function from one coord to many at once
+    :return: distances in km, nan where a coord is nan
+    """
+    R = 6371  # earths radius
+    lat, long = numpy.radians(lat), numpy.radians(long)
+    lat0, long0 = radians(lat0), radians(long0)
+
+    a = numpy.sin((lat - lat0) / 2) ** 2 + numpy.cos(lat) * cos(lat0) * numpy.sin((long - long0) / 2) ** 2
+    return 2 * R * numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1 - a))
+
+
 async def get_my_public_ip() -> Union[str, None]:
     """
     gets external_ip from the router
@@ -52,6 +74,7 @@ async def get_my_public_ip() -> Union[str, None]:
         try:
             external_ip = requests.get('https://api.ipify.org', timeout=2).content.decode('utf8')
             await db_utils.set_configuration('external_ip', external_ip)
+            set_external_ip(external_ip)
             return external_ip
         except:
             return None
@@ -66,27 +89,115 @@ def calc_distance(ip_address1: str, ip_address2: str) -> Union[float, None]:
     :return: distance in km | None if failed
     """
     # check if addresses are in the database
-    info1: Tuple = get_info(ip_address1)
-    info2: Tuple = get_info(ip_address2)
-    if None in [info1, info2]:
+    return info_distance(get_info(ip_address1), get_info(ip_address2))
+
+
+def info_distance(info1: Union[Tuple, None], info2: Union[Tuple, None]) -> Union[float, None]:
+    """
+    calculates the distance between two geolocation infos (see get_info)
+    :return: distance in km | None if one is missing
+    """
+    if info1 is None or info2 is None or None in (info1[2], info1[3], info2[2], info2[3]):
         return None
 
     return __calc_haversine(info1[2], info1[3], info2[2], info2[3])
 
 
-def get_info(ip_address: str) -> Union[Tuple[str, str, float, float], None]:
+class GeoIPReader(object):
     """
-    gets geolocation info about ip
-    :param ip_address: ip_address
-    :return: tuple: city, country code, latitude, longitude | None if failed
+    the geolocation database, opened once (memory mapped) and shared by every thread
+    lookups are cached per network: /24 for ipv4 and /64 for ipv6, the database rarely splits them.
+    the file is reopened when it changes on disk, and while it is missing every lookup fails (returns None)
     """
-    with database.Reader(abs_db_path(__database_path)) as reader:
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.reader: Union[database.Reader, None] = None
+        self.mtime = None
+        self.last_check = float('-inf')  # monotonic time starts near 0 on a fresh boot
+        self.__cached_lookup = lru_cache(maxsize=_CACHE_SIZE)(self.__lookup)
+
+    def lookup(self, ip_address: str) -> Union[Tuple[str, str, float, float], None]:
+        """
+        :return: tuple: city, country code, latitude, longitude | None if failed
+        """
+        self.__check_reload()
+        network = self.__network(ip_address)
+        if network is None:
+            return None
+        return self.__cached_lookup(network)
+
+    def lookup_many(self, ip_addresses: Iterable[str]) -> List[Union[Tuple[str, str, float, float], None]]:
+        """
+        batch lookup, addresses of the same network are looked up once
+        :return: the info of every address, in order
+        """
+        self.__check_reload()
+        networks = [self.__network(ip_address) for ip_address in ip_addresses]
+        results = {network: self.__cached_lookup(network) for network in set(networks) if network is not None}
+        return [results.get(network) for network in networks]
+
+    def __check_reload(self):
+        now = time.monotonic()
+        if now - self.last_check < _RELOAD_CHECK_INTERVAL:
+            return
+        with self.lock:
+            if now - self.last_check < _RELOAD_CHECK_INTERVAL:
+                return
+            self.last_check = now
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError:
+                mtime = None
+            if mtime == self.mtime:
+                return
+
+            # the old reader is left to the garbage collector, other threads may still be reading it
+            self.reader = database.Reader(str(self.path), mode=database.MODE_MMAP) if mtime is not None else None
+            self.mtime = mtime
+            self.__cached_lookup.cache_clear()
+
+    @staticmethod
+    def __network(ip_address: str) -> Union[str, None]:
+        # the first address of the cached network
+        try:
+            if ':' in ip_address:
+                return socket.inet_ntop(socket.AF_INET6, socket.inet_pton(socket.AF_INET6, ip_address)[:8] + bytes(8))
+            return socket.inet_ntop(socket.AF_INET, socket.inet_pton(socket.AF_INET, ip_address)[:3] + b'\x00')
+        except (OSError, ValueError):
+            return None
+
+    def __lookup(self, network: str) -> Union[Tuple[str, str, float, float], None]:
+        reader = self.reader
+        if reader is None:
+            return None
         try:
-            response = reader.city(ip_address)
+            response = reader.city(network)
             city = response.city.name
             country = response.country.iso_code
             latitude = response.location.latitude
             longitude = response.location.longitude
             return city, country, latitude, longitude
-        except errors.AddressNotFoundError:
+        except (errors.AddressNotFoundError, ValueError):
             return None
+
+
+GEOIP = GeoIPReader(abs_db_path(__database_path))
+
+
+def get_info(ip_address: str) -> Union[Tuple[str, str, float, float], None]:
+    """
+    gets geolocation info about ip
+    :param ip_address: ip_address
+    :return: tuple: city, country code, latitude, longitude | None if failed
+    """
+    return GEOIP.lookup(ip_address)
+
+
+def get_info_many(ip_addresses: List[str]) -> List[Union[Tuple[str, str, float, float], None]]:
+    """
+    gets geolocation info about many ips at once
+    :return: the info of every ip, in order (None where failed)
+    """
+    return GEOIP.lookup_many(ip_addresses)
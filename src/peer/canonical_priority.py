@@ -0,0 +1,112 @@
+import src.app_data.db_utils as db_utils
+
+from functools import lru_cache
+from typing import Dict, Tuple, Union
+import ipaddress
+import struct
+import crc32c
+
+
+# BEP 40 masks, picked by how much of the addresses is shared
+_V4_MASKS = (0xFFFF5555, 0xFFFFFF55, 0xFFFFFFFF)  # different /16, same /16, same /24
+_V6_MASKS = (  # applied to the upper 64 bits. different /32, same /32, same /40
+    0xFFFFFFFF55555555,
+    0xFFFFFFFFFF555555,
+    0xFFFFFFFFFFFFFFFF
+)
+_LOWER_64 = (1 << 64) - 1
+
+# our external address per ip version: ip, port
+_EXTERNAL_ADDRESSES: Dict[int, Tuple[Union[int, None], int]] = dict()
+
+
+def set_external_ip(ip: str, version: int = 4):
+    """
+    updates the cached external ip, call it whenever the external ip changes
+    """
+    _EXTERNAL_ADDRESSES.pop(version, None)
+    if ip:
+        _EXTERNAL_ADDRESSES[version] = int(ipaddress.ip_address(ip)), __external_port(version)
+
+
+def external_address(version: int) -> Tuple[Union[int, None], int]:
+    """
+    reads the external address of this ip version from the configuration once
+    :return: ip as an int (None if unknown), port
+    """
+    if version not in _EXTERNAL_ADDRESSES:
+        ip = db_utils.get_configuration('external_ip' if version == 4 else 'external_ipv6')
+        _EXTERNAL_ADDRESSES[version] = int(ipaddress.ip_address(ip)) if ip else None, __external_port(version)
+    return _EXTERNAL_ADDRESSES[version]
+
+
+def __external_port(version: int) -> int:
+    forward = db_utils.get_configuration('v4_forward' if version == 4 else 'v6_forward')
+    return forward['external_port'] if forward else 0
+
+
+@lru_cache(maxsize=4096)
+def canonical_priority(ip1: int, port1: int, ip2: int, port2: int, version: int = 4) -> int:
+    """
+    BEP 40 canonical peer priority of two endpoints, works on the packed addresses
+    :param ip1: address as an int
+    :param ip2: address as an int
+    :return: crc32c priority, the same for both sides of the connection
+    """
+    if ip1 == ip2:
+        # same ip, use the ports
+        return crc32c.crc32c(struct.pack('>HH', *sorted((port1, port2))))
+
+    if version == 4:
+        differ = ip1 ^ ip2
+        mask = _V4_MASKS[0 if differ >> 16 else 1 if differ >> 8 else 2]
+        ip1, ip2 = sorted((ip1 & mask, ip2 & mask))
+        return crc32c.crc32c(struct.pack('>II', ip1, ip2))
+
+    differ = ip1 ^ ip2
+    mask = _V6_MASKS[0 if differ >> 96 else 1 if differ >> 88 else 2]
+    ip1, ip2 = sorted((ip1 & (mask << 64 | _LOWER_64), ip2 & (mask << 64 | _LOWER_64)))
+    return crc32c.crc32c(ip1.to_bytes(16, 'big') + ip2.to_bytes(16, 'big'))
+
+
+def peer_priority(peer_ip: str, peer_port: int = 0) -> int:
+    """
+    BEP 40 priority of a peer against our external address
+    :return: priority, 0 if our external address of that ip version is unknown
+    """
+    packed_ip, version = packed_address(peer_ip)
+    external_ip, external_port = external_address(version)
+    if external_ip is None:
+        return 0
+    return canonical_priority(packed_ip, peer_port, external_ip, external_port, version)
+
+
+@lru_cache(maxsize=4096)
+def packed_address(ip: str) -> Tuple[int, int]:
+    """
+    :return: address as an int, ip version (ipv4 mapped addresses are ipv4)
+    """
+    address = ipaddress.ip_address(ip)
+    if address.version == 6 and address.ipv4_mapped:
+        address = address.ipv4_mapped
+    return int(address), address.version
+
+
+if __name__ == '__main__':
+    import timeit
+    import random
+
+    # examples from BEP 40
+    assert canonical_priority(int(ipaddress.ip_address('123.213.32.10')), 0, int(ipaddress.ip_address('98.76.54.32')), 0) == 0xec2d7224
+    assert canonical_priority(int(ipaddress.ip_address('123.213.32.10')), 0, int(ipaddress.ip_address('123.213.32.234')), 0) == 0x99568189
+
+    set_external_ip('123.213.32.10', 4)
+    set_external_ip('2001:db8::1', 6)
+    peers_v4 = [str(ipaddress.IPv4Address(random.getrandbits(32))) for _ in range(4_000)]
+    peers_v6 = [str(ipaddress.IPv6Address(random.getrandbits(128))) for _ in range(4_000)]
+    for name, peers in [('v4', peers_v4), ('v6', peers_v6)]:
+        canonical_priority.cache_clear()
+        packed_address.cache_clear()
+        cold = timeit.timeit(lambda: [peer_priority(ip) for ip in peers], number=1)
+        warm = timeit.timeit(lambda: [peer_priority(ip) for ip in peers], number=1)
+        print(f'{name}: {len(peers) / cold:,.0f} peers/s uncached, {len(peers) / warm:,.0f} peers/s cached')
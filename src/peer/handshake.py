@@ -46,3 +46,11 @@ async def handshake(TorrentData: Torrent, reader, writer) -> Union[bytes, None]:
     # validate the protocol
     peer_id = __validate_handshake(data, TorrentData.info_hash)
     return peer_id
+
+
+async def answer_handshake(TorrentData: Torrent, writer):
+    """
+    answers an incoming peer, its handshake was already read and validated by the acceptor
+    """
+    writer.write(__build__handshake_packet(TorrentData.info_hash, TorrentData.peer_id))
+    await writer.drain()
@@ -16,6 +16,7 @@ PORT = 9
 # default request block size
 BLOCK_SIZE = 2 ** 14
 MAX_ALLOWED_MSG_SIZE = 2 ** 15 + 9
+MAX_REQUEST_LENGTH = MAX_ALLOWED_MSG_SIZE - 9  # longest block a leecher may request
 
 
 class Chock:
@@ -150,6 +151,17 @@ class Piece:
         self.length = len(data)
         self.data = data
 
+    @staticmethod
+    def encode_header(piece_index: int, begin: int, length: int) -> bytes:
+        """
+        header of a piece message, the block itself is sent separately (sendfile)
+        """
+        return struct.pack('>IBII',
+                           length + 9,
+                           PIECE,
+                           piece_index,
+                           begin)
+
     @staticmethod
     def encode(piece_index, begin, data) -> bytes:
         return struct.pack(f'>IBII{len(data)}s',
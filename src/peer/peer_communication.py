@@ -1,7 +1,7 @@
 from typing import Tuple, List
 from src.torrent.torrent_object import Torrent
 from .peer_object import Peer
-from .handshake import handshake, open_tcp_connection
+from .handshake import handshake, answer_handshake, open_tcp_connection
 from .message_types import *
 from src.download.piece_picker import PiecePicker, Block
 from src.download.upload_in_download import TitForTat
@@ -98,19 +98,28 @@ class Stream(object):
                 raise AssertionError
 
 
-async def tcp_wire_communication(peerData: Tuple, TorrentData: Torrent, file_manager: File, piece_picker: PiecePicker, chocking_manager: TitForTat):
+async def tcp_wire_communication(peerData: Tuple, TorrentData: Torrent, file_manager: File, piece_picker: PiecePicker, chocking_manager: TitForTat, inbound: Tuple = None):
+    """
+    :param inbound: reader, writer, peer id of a peer that connected to me (handshake already received), None to connect to the peer
+    """
     address, city, distance = peerData
     try:
-        reader, writer = await asyncio.wait_for(open_tcp_connection(address), timeout=3)
-        if (reader, writer) == (None, None):
-            return
+        if inbound is None:
+            reader, writer = await asyncio.wait_for(open_tcp_connection(address), timeout=3)
+            if (reader, writer) == (None, None):
+                return
+        else:
+            reader, writer, peer_id = inbound
 
         thisPeer = Peer(writer, TorrentData, address, city)
         request_queue: List[Tuple[int, int, int]] = []
         balance_counter = 0
         try:
-            # start with a handshake
-            peer_id = await asyncio.wait_for(handshake(TorrentData, reader, writer), timeout=10)
+            if inbound is None:
+                # start with a handshake
+                peer_id = await asyncio.wait_for(handshake(TorrentData, reader, writer), timeout=10)
+            else:
+                await answer_handshake(TorrentData, writer)
             # validate the protocol
             assert peer_id
 
@@ -174,7 +183,7 @@ async def tcp_wire_communication(peerData: Tuple, TorrentData: Torrent, file_man
                             if len(request_queue) > _MAX_REQUESTS:
                                 # attempted dos detected
                                 print('banned ', thisPeer.address[0])
-                                db_utils.BannedPeersDB().insert_ip(thisPeer.address[0])
+                                db_utils.ban_peer(thisPeer.address[0])
                                 raise AssertionError
                         else:
                             pass
@@ -0,0 +1,110 @@
+from src.seeding.registry import SEEDING_REGISTRY
+from src.seeding.handshake import parse_handshake, validate_peer_ip
+
+from typing import Dict, Tuple, Callable, Awaitable, Union
+import threading
+import asyncio
+import socket
+import ipaddress
+
+
+_HANDSHAKE_LENGTH = 68
+_HANDSHAKE_TIMEOUT = 10
+_BACKLOG = 128
+
+
+class Acceptor(object):
+    """
+    the one listener of the client, incoming connections of every torrent arrive here
+    the handshake is read straight from the socket and routed by info_hash:
+    torrents we seed are served by the seeding server, torrents we are downloading
+    are handed to the event loop of their download session (each download runs its own thread and loop)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # info_hash -> event loop of the download, handler(sock, address, peer_id) that runs in that loop
+        self.downloads: Dict[bytes, Tuple[asyncio.AbstractEventLoop, Callable[..., Awaitable]]] = dict()
+        self.seeding_handler: Union[Callable[..., Awaitable], None] = None
+        # called with (conn, address, handshake) for torrents that are not routed here, in a seeding worker
+        # it hands the connection to the main process. None closes the connection
+        self.fallback: Union[Callable, None] = None
+
+    def register(self, info_hash: bytes, loop: asyncio.AbstractEventLoop, handler: Callable[..., Awaitable]):
+        with self.lock:
+            self.downloads[info_hash] = loop, handler
+
+    def unregister(self, info_hash: bytes):
+        with self.lock:
+            self.downloads.pop(info_hash, None)
+
+    @staticmethod
+    def listen(host: str, port: int, reuse_port: bool = False) -> socket.socket:
+        """
+        opens a listening socket
+        :param reuse_port: let seeding worker processes listen on the same port (SO_REUSEPORT)
+        :raises OSError: the port is occupied (or invalid)
+        """
+        family = socket.AF_INET6 if ipaddress.ip_address(host).version == 6 else socket.AF_INET
+        sock = socket.create_server((host, port), family=family, backlog=_BACKLOG, reuse_port=reuse_port)
+        sock.setblocking(False)
+        return sock
+
+    async def serve_forever(self, sock: socket.socket):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                conn, address = await loop.sock_accept(sock)
+                conn.setblocking(False)
+                asyncio.create_task(self.__route(conn, address))
+        finally:
+            sock.close()
+
+    def route(self, conn: socket.socket, address: Tuple, data: bytes):
+        """
+        routes a connection whose handshake was already read (by a seeding worker)
+        """
+        conn.setblocking(False)
+        asyncio.create_task(self.__route(conn, address, data))
+
+    async def __route(self, conn: socket.socket, address: Tuple, data: bytes = None):
+        try:
+            if data is None:
+                data = await asyncio.wait_for(self.__receive_handshake(conn), _HANDSHAKE_TIMEOUT)
+            info_hash, peer_id = parse_handshake(data)
+            if not info_hash:
+                raise AssertionError
+
+            if SEEDING_REGISTRY.get(info_hash) is not None and self.seeding_handler is not None:
+                reader, writer = await asyncio.open_connection(sock=conn)
+                await self.seeding_handler(reader, writer, info_hash, peer_id)
+                return
+
+            with self.lock:
+                download = self.downloads.get(info_hash)
+            if download is None and self.fallback is not None:
+                self.fallback(conn, address, data)
+                return
+            if download is None or not validate_peer_ip(address[0]):
+                raise AssertionError
+
+            download_loop, handler = download
+            # the socket belongs to the download loop from now on
+            asyncio.run_coroutine_threadsafe(handler(conn, address[:2], peer_id), download_loop)
+
+        except Exception:
+            conn.close()
+
+    @staticmethod
+    async def __receive_handshake(conn: socket.socket) -> bytes:
+        loop = asyncio.get_running_loop()
+        data = b''
+        while len(data) < _HANDSHAKE_LENGTH:
+            chunk = await loop.sock_recv(conn, _HANDSHAKE_LENGTH - len(data))
+            if not chunk:
+                raise ConnectionResetError
+            data += chunk
+        return data
+
+
+ACCEPTOR = Acceptor()
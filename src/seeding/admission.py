@@ -0,0 +1,113 @@
+import src.app_data.db_utils as db_utils
+
+from collections import deque, defaultdict
+from typing import Deque, Dict, List, Union
+import ipaddress
+import heapq
+import time
+
+
+_GRACE_PERIOD = 30  # seconds a new connection can't be evicted
+_COMPACT_SLACK = 64  # released entries kept in the heap before it is rebuilt
+
+
+class Admission(object):
+    """
+    slot of an admitted connection
+    """
+
+    __slots__ = ('priority', 'seq', 'writer', 'subnet', 'admitted_at', 'alive')
+
+    def __init__(self, priority: int, seq: int, writer, subnet: str):
+        self.priority = priority
+        self.seq = seq
+        self.writer = writer
+        self.subnet = subnet
+        self.admitted_at = time.monotonic()
+        self.alive = True
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class AdmissionController(object):
+    """
+    decides which leechers may connect to the seeding server
+    admitted connections are kept in a min-heap by BEP 40 priority, when the server is full
+    the lowest priority connection is evicted if the newcomer ranks above it (O(log n)).
+    new connections get a grace period before they can be evicted, and every subnet is capped
+    so a single network can't take over the server
+    """
+
+    def __init__(self, max_leechers: int, max_per_subnet: int):
+        self.max_leechers = max_leechers
+        self.max_per_subnet = max_per_subnet
+        self.heap: List[Admission] = []  # evictable connections, released ones are dropped lazily
+        self.grace: Deque[Admission] = deque()  # connections in their grace period, by admission time
+        self.subnets: Dict[str, int] = defaultdict(int)
+        self.admitted = 0
+        self.seq = 0
+
+    def admit(self, writer, ip: str, priority: int) -> Union[Admission, None]:
+        """
+        :param writer: closed if the connection is evicted later
+        :return: the slot of the connection, None if refused
+        """
+        subnet = self.subnet(ip)
+        if self.subnets.get(subnet, 0) >= self.max_per_subnet:
+            return None
+
+        self.__expire_grace()
+        if self.admitted >= self.max_leechers:
+            victim = self.__lowest()
+            if victim is None or victim.priority >= priority:
+                return None
+            heapq.heappop(self.heap)
+            self.release(victim)
+            victim.writer.close()  # its handler exits, releasing again is a no-op
+
+        self.seq += 1
+        admission = Admission(priority, self.seq, writer, subnet)
+        self.grace.append(admission)
+        self.subnets[subnet] += 1
+        self.admitted += 1
+        return admission
+
+    def release(self, admission: Admission):
+        if not admission.alive:
+            return
+        admission.alive = False
+        self.admitted -= 1
+        self.subnets[admission.subnet] -= 1
+        if self.subnets[admission.subnet] <= 0:
+            del self.subnets[admission.subnet]
+
+        if len(self.heap) > 2 * self.admitted + _COMPACT_SLACK:
+            self.heap = [x for x in self.heap if x.alive]
+            heapq.heapify(self.heap)
+
+    def __expire_grace(self):
+        rn = time.monotonic()
+        while self.grace and (not self.grace[0].alive or rn - self.grace[0].admitted_at >= _GRACE_PERIOD):
+            admission = self.grace.popleft()
+            if admission.alive:
+                heapq.heappush(self.heap, admission)
+
+    def __lowest(self) -> Union[Admission, None]:
+        while self.heap and not self.heap[0].alive:
+            heapq.heappop(self.heap)
+        return self.heap[0] if self.heap else None
+
+    @staticmethod
+    def subnet(ip: str) -> str:
+        """
+        :return: the /24 of an ipv4 address, the /48 of an ipv6 address
+        """
+        address = ipaddress.ip_address(ip)
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        prefix = 24 if address.version == 4 else 48
+        return str(ipaddress.ip_network((address, prefix), strict=False))
+
+
+ADMISSION = AdmissionController(db_utils.get_configuration('max_leecher_peers'), db_utils.get_configuration('max_leechers_per_subnet'))
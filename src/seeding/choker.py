@@ -0,0 +1,122 @@
+import src.app_data.db_utils as db_utils
+from src.peer.message_types import Chock, Unchock
+from src.seeding.leecher_object import Leecher
+from src.seeding.upload_scheduler import UPLOAD_SCHEDULER
+
+from typing import Set, Tuple
+from random import choice
+import asyncio
+import time
+
+
+_RECHOKE_INTERVAL = 10  # seconds between choking rounds
+_OPTIMISTIC_ROUNDS = 3  # the optimistic slot rotates every 30 seconds
+_ROUND_ROBIN_TIME = 60  # in round robin, leechers unchoked for longer make room for waiting ones
+
+# seed choking algorithms
+FASTEST_UPLOAD = 'fastest_upload'  # keep the leechers we upload to the fastest
+ROUND_ROBIN = 'round_robin'  # give every interested leecher a turn
+
+
+class SeedChoker(object):
+    """
+    choker of the seeding server
+    only a few leechers are unchoked at once so each one gets a useful rate instead of a trickle.
+    the regular slots are rotated every round by upload rate and time since unchoke,
+    one optimistic slot is rotated randomly to give new leechers a chance
+    """
+
+    def __init__(self, upload_slots: int, algorithm: str = FASTEST_UPLOAD):
+        self.upload_slots = max(upload_slots, 1)
+        self.algorithm = algorithm
+        self.optimistic: Leecher = None  # optimistically unchoked leecher
+        self.round = 0
+
+    async def loop(self):
+        while True:
+            await asyncio.sleep(_RECHOKE_INTERVAL)
+            self.rechoke()
+
+    def rechoke(self):
+        self.round += 1
+        interested = [leecher for leecher in Leecher.leecher_instances if leecher.am_interested]
+
+        # rotate the optimistic slot
+        if self.optimistic not in interested or self.round % _OPTIMISTIC_ROUNDS == 0:
+            candidates = [leecher for leecher in interested if leecher.am_chocked]
+            # leechers that were never unchoked get the first chance
+            newcomers = [leecher for leecher in candidates if leecher.last_unchoke == 0]
+            self.optimistic = choice(newcomers or candidates) if candidates else None
+
+        regular = [leecher for leecher in interested if leecher is not self.optimistic]
+        regular.sort(key=self.__rank_key(time.time()))
+        unchoked: Set[Leecher] = set(regular[:self.upload_slots - 1])
+        if self.optimistic is not None:
+            unchoked.add(self.optimistic)
+        else:  # no one to rotate, give the slot to the next regular leecher
+            unchoked.update(regular[self.upload_slots - 1:self.upload_slots])
+
+        for leecher in list(Leecher.leecher_instances):
+            try:
+                if leecher in unchoked:
+                    self.unchoke(leecher)
+                else:
+                    self.choke(leecher)
+            except Exception as e:  # one broken connection must not stop the rounds
+                print(f'failed to rechoke {leecher}: {e}')
+
+    def report_interested(self, leecher: Leecher):
+        leecher.am_interested = True
+        if self.free_slots > 0:
+            self.unchoke(leecher)
+
+    def report_uninterested(self, leecher: Leecher):
+        leecher.am_interested = False
+        self.choke(leecher)
+        self.fill_slots()
+
+    def report_disconnected(self, leecher: Leecher):
+        if leecher is self.optimistic:
+            self.optimistic = None
+        if not leecher.am_chocked:
+            leecher.am_chocked = True
+            self.fill_slots()
+
+    def fill_slots(self):
+        # hand free slots to the interested leechers that waited the longest
+        waiting = sorted([leecher for leecher in Leecher.leecher_instances if leecher.am_interested and leecher.am_chocked], key=lambda x: x.last_unchoke)
+        for leecher in waiting[:self.free_slots]:
+            self.unchoke(leecher)
+
+    @property
+    def free_slots(self) -> int:
+        return self.upload_slots - sum(1 for leecher in Leecher.leecher_instances if not leecher.am_chocked)
+
+    @staticmethod
+    def unchoke(leecher: Leecher):
+        if leecher.am_chocked:
+            leecher.am_chocked = False
+            leecher.last_unchoke = time.time()
+            leecher.send(Unchock.encode())
+
+    @staticmethod
+    def choke(leecher: Leecher):
+        if not leecher.am_chocked:
+            leecher.am_chocked = True
+            UPLOAD_SCHEDULER.clear(leecher)  # requests are discarded when choked
+            leecher.send(Chock.encode())
+
+    def __rank_key(self, rn: float):
+        if self.algorithm == ROUND_ROBIN:
+            def key(leecher: Leecher) -> Tuple[int, float]:
+                if not leecher.am_chocked and rn - leecher.last_unchoke < _ROUND_ROBIN_TIME:
+                    return 0, -leecher.download_rate  # keep the current turn
+                if leecher.am_chocked:
+                    return 1, leecher.last_unchoke  # waited the longest
+                return 2, -leecher.download_rate  # had its turn
+            return key
+
+        return lambda leecher: -leecher.download_rate
+
+
+SEED_CHOKER = SeedChoker(db_utils.get_configuration('max_upload_slots'), db_utils.get_configuration('seed_choking_algorithm'))
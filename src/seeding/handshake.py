@@ -1,13 +1,9 @@
-import asyncio
-import copy
-
 import src.app_data.db_utils as db_utils
-from src.file.file_object import PickableFile
 from src.geoip.utils import get_info
+from .registry import SEEDING_REGISTRY
 from .utils import *
 from typing import Tuple, Union
 import struct
-import os
 
 
 def validate_peer_ip(peer_ip: str) -> Union[Tuple[str, str, float, float], None]:
@@ -36,7 +32,11 @@ def __build__handshake_packet(info_hash: bytes, peer_id: bytes) -> bytes:
     return data
 
 
-def __get_handshake_data(data: bytes) -> Union[Tuple[bytes, bytes], Tuple[None, None]]:
+def parse_handshake(data: bytes) -> Union[Tuple[bytes, bytes], Tuple[None, None]]:
+    """
+    :param data: the 68 bytes handshake of the peer
+    :return: info hash, peer id | None, None if it's not a bittorrent handshake
+    """
     string_format = '>20sQ20s20s'
     len_n_protocol, extensions, info_hash, peer_id = struct.unpack(string_format, data)
     if len_n_protocol == b'\x13BitTorrent protocol':
@@ -45,35 +45,19 @@ def __get_handshake_data(data: bytes) -> Union[Tuple[bytes, bytes], Tuple[None,
         return None, None
 
 
-async def handshake(reader, writer) -> Union[Tuple[PickableFile, bytes], Tuple[None, None]]:
-    data = await reader.read(68)  # len of handshake
-    info_hash, peer_id = __get_handshake_data(data)
-    # validate the protocol
-    if not info_hash:
-        return None, None
-
-    # check if I have this torrent
-    file_object: PickableFile = db_utils.CompletedTorrentsDB().get_torrent(info_hash)
+async def handshake(writer, info_hash: bytes) -> bool:
+    """
+    answers the handshake of a leecher, the acceptor already read it
+    :return: whether I seed this torrent
+    """
+    # check if I have this torrent, the registry checks the files on its own timer
+    file_object = SEEDING_REGISTRY.get(info_hash)
     if not file_object:
-        return None, None
-
-    # check if all files exist
-    for path in file_object.file_names:
-        if not os.path.exists(path):
-            db_utils.CompletedTorrentsDB().delete_torrent(info_hash)
-            print('files not found!')
-            return None, None
+        return False
 
     # send handshake
     handshake_packet = __build__handshake_packet(info_hash, file_object.peer_id)
     writer.write(handshake_packet)
     await writer.drain()
 
-    # store in global to prevent high ram usage in ddos
-    if file_object.info_hash not in FileObjects:
-        async with asyncio.Lock():
-            FileObjects[info_hash] = copy.deepcopy(file_object)
-    del file_object
-
-    return info_hash, peer_id
-
+    return True
@@ -1,13 +1,15 @@
 import src.app_data.db_utils as db_utils
 import time
-from typing import Tuple, List
+from collections import deque
+from typing import Tuple, List, Set, Deque
 
 
 class Leecher(object):
     leecher_instances: List = []
 
-    def __init__(self, writer, address: Tuple[str, int], geodata: Tuple[str, str, float, float], peer_id: bytes, priority: int):
+    def __init__(self, writer, file_object, address: Tuple[str, int], geodata: Tuple[str, str, float, float], peer_id: bytes, priority: int):
         self.writer = writer
+        self.file_object = file_object
 
         Leecher.leecher_instances.append(self)
 
@@ -16,8 +18,21 @@ class Leecher(object):
 
         self.am_chocked = True  # have I chocked the peer?
         self.am_interested = False  # is the peer interested in what I offer?
-
-        self.pipelined_requests: List[Tuple[int, int, int]] = []
+        self.last_unchoke = 0  # when the peer got an upload slot, 0 if never
+
+        # requests in arrival order, the set holds the ones not yet served or cancelled
+        self.pipelined_requests: Deque[Tuple[int, int, int]] = deque()
+        self.pending_requests: Set[Tuple[int, int, int]] = set()
+        self.deficit = 0  # bytes left of the upload scheduler quantum
+        self.scheduled = False  # waiting for a turn in the upload scheduler
+        self.sending = False
+        # the transport can't be written while a block goes through sendfile, messages wait for the block to end
+        self.in_sendfile = False
+        self.held_messages: List[bytes] = []
+
+        # super seeding
+        self.bitfield = None  # pieces the peer told us it has
+        self.revealed: Set[int] = set()  # pieces we advertised to the peer
 
         self.last_data_sent = time.time()
 
@@ -29,6 +44,22 @@ class Leecher(object):
         self.peer_id = peer_id
         self.client = db_utils.get_client(peer_id)
 
+    def send(self, data: bytes):
+        """
+        the only way messages are written to the leecher, besides the blocks of the upload scheduler
+        """
+        if self.in_sendfile:
+            self.held_messages.append(data)
+        elif not self.writer.is_closing():
+            self.writer.write(data)
+
+    def release_held(self):
+        # called by the upload scheduler between blocks
+        self.in_sendfile = False
+        held, self.held_messages = self.held_messages, []
+        if held and not self.writer.is_closing():
+            self.writer.write(b''.join(held))
+
     def update_download_rate(self, len_bytes_sent: int):
         self.download_counter += len_bytes_sent
         rn = time.time()
@@ -0,0 +1,103 @@
+import src.app_data.db_utils as db_utils
+from src.file.file_object import PickableFile
+from src.file.fd_pool import FILE_POOL
+
+from collections import defaultdict
+from typing import Dict, Set, List, Tuple, Union
+import asyncio
+import os
+
+
+class SeedingRegistry(object):
+    """
+    in-memory registry of the torrents we seed, keyed by info_hash
+    loaded once from CompletedTorrentsDB and shared read-only by every connection, storage goes through the file pool.
+    files are checked on a timer instead of on every handshake
+    """
+
+    def __init__(self):
+        self.torrents: Dict[bytes, PickableFile] = dict()
+        self.refcounts: Dict[bytes, int] = defaultdict(int)  # connections using the torrent
+        self.retired: Dict[bytes, PickableFile] = dict()  # removed from the registry while still in use
+
+    def load(self):
+        """
+        note: blocking function!
+        """
+        for info_hash, file_object in self.scan()[0].items():
+            self.torrents[info_hash] = file_object
+
+    def get(self, info_hash: bytes) -> Union[PickableFile, None]:
+        return self.torrents.get(info_hash)
+
+    def acquire(self, info_hash: bytes) -> Union[PickableFile, None]:
+        file_object = self.torrents.get(info_hash)
+        if file_object is not None:
+            self.refcounts[info_hash] += 1
+        return file_object
+
+    def release(self, info_hash: bytes):
+        self.refcounts[info_hash] -= 1
+        if self.refcounts[info_hash] <= 0:
+            del self.refcounts[info_hash]
+            if info_hash in self.retired:
+                FILE_POOL.forget(self.retired.pop(info_hash).file_names)
+
+    def remove(self, info_hash: bytes):
+        file_object = self.torrents.pop(info_hash, None)
+        if file_object is None:
+            return
+        if self.refcounts.get(info_hash):
+            self.retired[info_hash] = file_object
+        else:
+            FILE_POOL.forget(file_object.file_names)
+
+    def scan(self) -> Tuple[Dict[bytes, PickableFile], Set[bytes]]:
+        """
+        compares the registry with the database and the filesystem
+        note: blocking function! runs in a worker thread, the registry itself is not modified
+        :return: newly completed torrents, info hashes that are gone (deleted from the database or missing files)
+        """
+        # the singleton's connection belongs to whichever thread created it last, open one in this thread
+        database = db_utils.CompletedTorrentsConnection()
+        try:
+            known = set(self.torrents)
+            stored = set(database.get_all_info_hashes())
+
+            new_torrents = dict()
+            for info_hash in stored - known:
+                file_object = database.get_torrent(info_hash)
+                if file_object is not None:
+                    new_torrents[info_hash] = file_object
+
+            gone = known - stored
+            for info_hash, file_object in list(self.torrents.items()) + list(new_torrents.items()):
+                if info_hash in gone or self.__files_exist(file_object.file_names):
+                    continue
+                database.delete_torrent(info_hash)
+                print('files not found!')
+                gone.add(info_hash)
+                new_torrents.pop(info_hash, None)
+        finally:
+            database.close()
+
+        return new_torrents, gone
+
+    async def refresh_loop(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                new_torrents, gone = await asyncio.to_thread(self.scan)
+            except Exception as e:  # database locked or unreadable, keep serving the current torrents
+                print(f'failed to refresh the seeding registry: {e}')
+                continue
+            self.torrents.update(new_torrents)
+            for info_hash in gone:
+                self.remove(info_hash)
+
+    @staticmethod
+    def __files_exist(file_names: List[str]) -> bool:
+        return all(os.path.exists(path) for path in file_names)
+
+
+SEEDING_REGISTRY = SeedingRegistry()
@@ -1,161 +1,118 @@
-import copy
 import threading
 
 from .utils import *
 from src.peer.message_types import *
 from src.seeding.leecher_object import Leecher
+from src.seeding.stream import Stream
 from src.seeding.handshake import handshake, validate_peer_ip
+from src.seeding.registry import SEEDING_REGISTRY
+from src.seeding.choker import SEED_CHOKER
+from src.seeding.upload_scheduler import UPLOAD_SCHEDULER
+from src.seeding.admission import ADMISSION
+from src.peer.canonical_priority import peer_priority, set_external_ip
+from src.seeding.super_seeding import SUPER_SEEDER
+from src.seeding.acceptor import ACCEPTOR
+from src.seeding.workers import SEEDING_WORKERS, workers_supported, split_limits
 from src.file.file_object import PickableFile
 
 import asyncio
+import socket
 import upnpclient
 from math import ceil
 import bitstring
 from random import sample
 
 
-_BUFFER_SIZE = 4096
 _MAX_REQUESTS = 500
 _LEASE_DURATION = 600  # 10 minutes
-_MAX_LEECHER_PEERS = db_utils.get_configuration('max_leecher_peers')
+_REGISTRY_REFRESH_INTERVAL = db_utils.get_configuration('seeding_refresh_interval')
+_SUPER_SEEDING = db_utils.get_configuration('super_seeding')
+_SEEDING_WORKERS = db_utils.get_configuration('seeding_workers') or 1  # processes, including this one
+_REUSE_PORT = _SEEDING_WORKERS > 1 and workers_supported()
 
 SEEDING_SERVER_IS_UP = False
 
 
-class Stream(object):
-    def __init__(self, reader):
-        self.reader = reader
-        self.buffer = b''
-
-    def __consume(self, msg_length):
-        self.buffer = self.buffer[msg_length:]
-
-    def __aiter__(self):
-        return self
-
-    async def __anext__(self):
-        while True:
-            if self.buffer:
-                length = struct.unpack('>I', self.buffer[0:4])[0] + 4
-                if length == 4:  # keepalive
-                    self.__consume(4)
-                    continue
-
-                # defend overflow
-                if length > MAX_ALLOWED_MSG_SIZE:
-                    raise AssertionError
-
-                if len(self.buffer) < length:
-                    continue
-
-                msg = self.buffer[:length]
-                msg_id = msg[4]
-
-                self.__consume(length)
-
-            else:
-                data = await asyncio.wait_for(self.reader.read(_BUFFER_SIZE), 60)
-                self.buffer += data
-                if not self.buffer:
-                    raise StopAsyncIteration
-                continue
-
-            if msg_id == INTERESTED:
-                return Interested()
-            elif msg_id == NOT_INTERESTED:
-                return NotInterested()
-
-            elif msg_id == REQUEST:
-                return Request.decode(msg)
-            elif msg_id == CANCEL:
-                return Cancel.decode(msg)
-
-            elif msg_id in [CHOKE, UNCHOKE, HAVE, BITFIELD]:
-                continue
-
-            else:
-                # unsupported message
-                raise AssertionError
-
-
-async def handle_leecher(reader, writer):
+async def handle_leecher(reader, writer, info_hash: bytes, peer_id: bytes):
     leecher = None
+    file_object = None
+    admission = None
+    super_seed = None
+    stream = None
     try:
         # make sure peer is not dirty
         peer_address = writer.get_extra_info('peername')
         geodata = validate_peer_ip(peer_address[0])
         assert geodata
 
-        # prioritize ip. seeding only in ipv4
-        ip_priority = crc32c_sort_v4(peer_address[0])
-        if len(Leecher.leecher_instances) == _MAX_LEECHER_PEERS:
-            sorted_leechers = sorted(Leecher.leecher_instances, key=lambda x: x.priority)
-            if ip_priority > sorted_leechers[0]:
-                # kick that peer
-                sorted_leechers[0].writer.close()
-                await sorted_leechers[0].writer.wait_closed()
-            else:
-                raise ConnectionRefusedError
+        # prioritize ip
+        ip_priority = peer_priority(peer_address[0], peer_address[1])
+        admission = ADMISSION.admit(writer, peer_address[0], ip_priority)  # may kick a lower priority peer
+        if admission is None:
+            raise ConnectionRefusedError
 
         # handshake
-        info_hash, peer_id = await handshake(reader, writer)
-        assert info_hash
-
-        file_object: PickableFile = copy.deepcopy(FileObjects[info_hash])  # TODO don't use deepcopy, maybe a singleton?
-        file_object.reopen_files()
-
-        # send obfuscated bitfield
-        bitfield = bitstring.BitArray(bin='1' * file_object.num_pieces)
-        zero_indexes = sample(range(len(bitfield)), min(ceil(len(bitfield) / 10), 50))
-        for index in zero_indexes:
-            bitfield[index] = False
-        writer.write(Bitfield.encode(bitfield))
-        await writer.drain()
-        for index in zero_indexes:
-            writer.write(Have.encode(index))
-            await writer.drain()
+        if not await handshake(writer, info_hash):
+            raise AssertionError
 
-        leecher = Leecher(writer, peer_address, geodata, peer_id, ip_priority)
+        file_object: PickableFile = SEEDING_REGISTRY.acquire(info_hash)  # shared by every connection
+        if file_object is None:
+            raise AssertionError
+
+        leecher = Leecher(writer, file_object, peer_address, geodata, peer_id, ip_priority)
         print(leecher)
-        normalize = lambda value, max_value, new_min, new_max: (value / max_value) * (new_max - new_min) + new_min
-        async for msg in Stream(reader):
+
+        if _SUPER_SEEDING:
+            # no bitfield, we look like a peer with nothing. pieces are revealed one by one
+            super_seed = SUPER_SEEDER.connect(info_hash, file_object.num_pieces, leecher)
+            await writer.drain()
+        else:
+            # send obfuscated bitfield
+            bitfield = bitstring.BitArray(bin='1' * file_object.num_pieces)
+            zero_indexes = sample(range(len(bitfield)), min(ceil(len(bitfield) / 10), 50))
+            for index in zero_indexes:
+                bitfield[index] = False
+            leecher.send(Bitfield.encode(bitfield))
+            await writer.drain()
+            for index in zero_indexes:
+                leecher.send(Have.encode(index))
+                await writer.drain()
+
+        stream = Stream(reader, writer, file_object.num_pieces)
+        async for msg in stream:
             if isinstance(msg, Interested):
-                leecher.am_interested = True
-                leecher.am_chocked = False
-                writer.write(Unchock.encode())
+                SEED_CHOKER.report_interested(leecher)
                 await writer.drain()
             elif isinstance(msg, NotInterested):
-                leecher.am_interested = False
-                leecher.am_chocked = True
-                writer.write(Chock.encode())
+                SEED_CHOKER.report_uninterested(leecher)
                 await writer.drain()
 
+            elif isinstance(msg, Have):
+                if super_seed is not None:
+                    super_seed.report_have(leecher, msg.piece_index)
+                    await writer.drain()
+            elif isinstance(msg, Bitfield):
+                if super_seed is not None:
+                    super_seed.report_bitfield(leecher, msg.bitfield)
+                    await writer.drain()
+
             elif isinstance(msg, Request):
+                if not file_object.is_valid_request(msg.piece_index, msg.begin, msg.length):
+                    raise AssertionError  # out of the torrent's bounds, checked explicitly since -O strips asserts
+                if super_seed is not None and msg.piece_index not in leecher.revealed:
+                    # only the revealed pieces are served
+                    super_seed.report_unoffered_request(leecher)
+                    await writer.drain()
+                    continue
                 if not leecher.am_chocked:
-                    leecher.pipelined_requests.append((msg.piece_index, msg.begin, msg.length))
-                    if len(leecher.pipelined_requests) > _MAX_REQUESTS:
+                    UPLOAD_SCHEDULER.enqueue(leecher, (msg.piece_index, msg.begin, msg.length))
+                    if len(leecher.pending_requests) > _MAX_REQUESTS:
                         # attempted dos detected
-                        db_utils.BannedPeersDB().insert_ip(leecher.address[0])
+                        db_utils.ban_peer(leecher.address[0])
                         raise AssertionError
 
             elif isinstance(msg, Cancel):
-                if (details := (msg.piece_index, msg.begin, msg.length)) in leecher.pipelined_requests:
-                    leecher.pipelined_requests.remove(details)
-                else:
-                    pass
-
-            # fulfill 50% of request
-            for _ in range(0, len(leecher.pipelined_requests), 2):
-                piece_params = file_object.get_piece(*leecher.pipelined_requests.pop(0))
-                writer.write(Piece.encode(*piece_params))
-                await writer.drain()
-                # update statistics
-                file_object.uploaded += len(piece_params[2])
-                leecher.downloaded += len(piece_params[2])
-                leecher.update_download_rate(len(piece_params[2]))
-
-                # introduce more delay as peer is more and more demanding
-                await asyncio.sleep(normalize(len(leecher.pipelined_requests), _MAX_REQUESTS, 0.01, 0.20))
+                UPLOAD_SCHEDULER.cancel(leecher, (msg.piece_index, msg.begin, msg.length))
 
     except AssertionError as e:
         ...
@@ -163,14 +120,25 @@ async def handle_leecher(reader, writer):
     except Exception as e:
         print(f'An error occurred: {e}')
     finally:
+        if stream is not None:
+            stream.close()
+
+        if admission is not None:
+            ADMISSION.release(admission)
+
         if writer is not None:
             writer.close()
             await writer.wait_closed()
 
+        if file_object is not None:
+            SEEDING_REGISTRY.release(file_object.info_hash)
+
         if leecher in Leecher.leecher_instances:
-            FileObjects[info_hash].close_files()
             Leecher.leecher_instances.remove(leecher)
-            file_object.close_files()
+            UPLOAD_SCHEDULER.clear(leecher)
+            SEED_CHOKER.report_disconnected(leecher)
+            if super_seed is not None:
+                SUPER_SEEDER.disconnect(file_object.info_hash, leecher)
             del leecher
 
         return
@@ -181,14 +149,17 @@ async def start_seeding_server():
     global SEEDING_SERVER_IS_UP
     try:
         internal_ipv4, internal_ipv6 = get_internal_ip()
-        assert internal_ipv4
+        assert internal_ipv4 or internal_ipv6
 
-        async def forward_port(internal_ip: str, internal_port, external_port, last_forward, version: str) -> Tuple[asyncio.base_events.Server, float]:
+        # load the torrents to seed once, the registry refreshes itself on a timer
+        await asyncio.to_thread(SEEDING_REGISTRY.load)
+
+        async def forward_port(internal_ip: str, internal_port, external_port, last_forward, version: str) -> Tuple[socket.socket, float]:
             try:
-                server = await asyncio.start_server(handle_leecher, internal_ip, internal_port)
+                server = ACCEPTOR.listen(internal_ip, internal_port, _REUSE_PORT)
             except:  # the port is occupied
-                server = await asyncio.start_server(handle_leecher, internal_ip, 0)
-                internal_port = server.sockets[0].getsockname()[1]
+                server = ACCEPTOR.listen(internal_ip, 0, _REUSE_PORT)
+                internal_port = server.getsockname()[1]
                 # forward a new port
                 last_forward = 0
 
@@ -221,25 +192,60 @@ async def start_seeding_server():
 
             return server, last_forward
 
-        # load previous forwarding
-        internal_port_v4, external_port_v4, last_forward_v4 = load_forwarding('v4')
-        if internal_port_v4 == 0:
-            internal_port_v4 = -1
+        async def listen_v6(internal_ip: str, internal_port) -> socket.socket:
+            # global ipv6 addresses are reachable as they are, no NAT and no port forwarding
+            try:
+                server = ACCEPTOR.listen(internal_ip, internal_port, _REUSE_PORT)
+            except:  # the port is occupied
+                server = ACCEPTOR.listen(internal_ip, 0, _REUSE_PORT)
+                print(f'ipv6 port {internal_port} is occupied, listening on a random port')
+            internal_port = server.getsockname()[1]  # the port is random on first run
 
-        server_v4, last_forward_v4 = await forward_port(internal_ipv4, internal_port_v4, external_port_v4, last_forward_v4, 'v4')
-        SEEDING_SERVER_IS_UP = True
+            await save_forward(internal_port, internal_port, 'v6')
+            await db_utils.set_configuration('external_ipv6', internal_ip)
+            set_external_ip(internal_ip, 6)
+            print(f'listening on ipv6 port {internal_port}')
+
+            return server
 
-        # run server and updates thread
-        update_coroutine = await asyncio.to_thread(update_mapping, internal_port_v4, external_port_v4, internal_ipv4, last_forward_v4, 'v4')
-        async with server_v4:
-            await asyncio.gather(server_v4.serve_forever(), update_coroutine)
+        servers = []
+        coroutines = [SEEDING_REGISTRY.refresh_loop(_REGISTRY_REFRESH_INTERVAL), SEED_CHOKER.loop(), UPLOAD_SCHEDULER.loop()]
+
+        if internal_ipv4:
+            # load previous forwarding
+            internal_port_v4, external_port_v4, last_forward_v4 = load_forwarding('v4')
+            if internal_port_v4 == 0:
+                internal_port_v4 = -1
+
+            try:
+                server_v4, last_forward_v4 = await forward_port(internal_ipv4, internal_port_v4, external_port_v4, last_forward_v4, 'v4')
+                servers.append(server_v4)
+                # updates thread
+                coroutines.append(await asyncio.to_thread(update_mapping, internal_port_v4, external_port_v4, internal_ipv4, last_forward_v4, 'v4'))
+            except Exception as e:
+                if not internal_ipv6:
+                    raise
+                print(f'seeding only in ipv6: {e}')
+
+        if internal_ipv6:
+            # trackers are announced a single port, the forwarded ipv4 port. listen on it in ipv6 as well,
+            # the previous ipv6 listening port is used when no ipv4 port was ever forwarded
+            _, announced_port, _ = load_forwarding('v4')
+            internal_port_v6, _, _ = load_forwarding('v6')
+            server_v6 = await listen_v6(internal_ipv6, announced_port or internal_port_v6)
+            servers.append(server_v6)
+
+        if _REUSE_PORT:
+            # start the other seeding processes before serving anyone, the limits are split between the processes
+            split_limits(0, _SEEDING_WORKERS)
+            SEEDING_WORKERS.start(_SEEDING_WORKERS - 1, servers)
+            coroutines.append(SEEDING_WORKERS.loop())
+
+        SEEDING_SERVER_IS_UP = True
 
-        '''
-        internal_port_v6, external_port_v6, last_forward_v6 = load_forwarding('v6')
-        if internal_port_v6 == 0:
-            internal_port_v6 = -1
-        server_v6 = await forward_port(internal_ipv6, internal_port_v6, external_port_v6, last_forward_v6, 'v6')
-        '''
+        # run servers and updates thread. incoming connections of ongoing downloads are handed to them
+        ACCEPTOR.seeding_handler = handle_leecher
+        await asyncio.gather(*[ACCEPTOR.serve_forever(server) for server in servers], *coroutines)
 
     except AssertionError:
         ...
@@ -248,6 +254,7 @@ async def start_seeding_server():
         print(e)
     finally:
         SEEDING_SERVER_IS_UP = False
+        SEEDING_WORKERS.stop()
         return
 
 
@@ -0,0 +1,261 @@
+from src.peer.message_types import *
+
+from typing import Union
+import asyncio
+import struct
+
+
+_BUFFER_SIZE = 4096
+_IDLE_TIMEOUT = 60  # seconds without any data from the leecher
+_COMPACT_SIZE = 2 ** 16  # consumed bytes kept at the front of the buffer before it is compacted
+
+# exact lengths (with the length prefix) of the fixed size messages a leecher sends
+_MESSAGE_LENGTHS = {
+    CHOKE: 5,
+    UNCHOKE: 5,
+    INTERESTED: 5,
+    NOT_INTERESTED: 5,
+    HAVE: 9,
+    REQUEST: 17,
+    CANCEL: 17
+}
+
+
+class Stream(object):
+    """
+    framed reader of the messages a leecher sends
+    data is appended to one buffer and messages are parsed in place from an offset, the consumed part is
+    dropped only once in a while. more data is read only when the next message is incomplete,
+    and one timer per connection closes it when the leecher goes idle
+    """
+
+    def __init__(self, reader, writer, num_pieces: int, idle_timeout: float = _IDLE_TIMEOUT):
+        self.reader = reader
+        self.writer = writer
+        self.num_pieces = num_pieces
+        self.buffer = bytearray()
+        self.offset = 0  # start of the unparsed data
+
+        self.idle_timeout = idle_timeout
+        self.last_activity = 0
+        self.idle_timer: Union[asyncio.TimerHandle, None] = None
+        self.reading = False  # only a pending read can time out
+        self.timed_out = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            msg = self.__parse()
+            if msg is not None:
+                return msg
+
+            # the next message is incomplete
+            data = await self.__read()
+            if not data:
+                self.__stop_timer()
+                raise StopAsyncIteration
+            if self.offset >= _COMPACT_SIZE or self.offset == len(self.buffer):
+                del self.buffer[:self.offset]
+                self.offset = 0
+            self.buffer += data
+
+    def __parse(self) -> Union[object, None]:
+        """
+        :return: the next message, None if it didn't fully arrive yet
+        """
+        buffer, offset = self.buffer, self.offset
+        while len(buffer) - offset >= 4:
+            length = struct.unpack_from('>I', buffer, offset)[0] + 4
+            if length == 4:  # keepalive
+                offset += 4
+                continue
+
+            # defend overflow
+            if length > MAX_ALLOWED_MSG_SIZE:
+                raise AssertionError
+
+            if len(buffer) - offset < length:
+                break
+
+            msg_id = buffer[offset + 4]
+            if msg_id in _MESSAGE_LENGTHS and _MESSAGE_LENGTHS[msg_id] != length:
+                raise AssertionError
+            start, offset = offset, offset + length
+            self.offset = offset
+
+            if msg_id == INTERESTED:
+                return Interested()
+            elif msg_id == NOT_INTERESTED:
+                return NotInterested()
+
+            elif msg_id == REQUEST:
+                return Request(*struct.unpack_from('>III', buffer, start + 5))
+            elif msg_id == CANCEL:
+                return Cancel(*struct.unpack_from('>III', buffer, start + 5))
+
+            elif msg_id == HAVE:
+                msg = Have(struct.unpack_from('>I', buffer, start + 5)[0])
+                if msg.piece_index >= self.num_pieces:
+                    raise AssertionError
+                return msg
+            elif msg_id == BITFIELD:
+                msg = Bitfield.decode(bytes(buffer[start:offset]), self.num_pieces)
+                if len(msg.bitfield) != self.num_pieces:
+                    raise AssertionError
+                return msg
+
+            elif msg_id in [CHOKE, UNCHOKE]:
+                continue
+
+            else:
+                # unsupported message
+                raise AssertionError
+
+        self.offset = offset
+        return None
+
+    async def __read(self) -> bytes:
+        loop = asyncio.get_running_loop()
+        self.last_activity = loop.time()
+        if self.idle_timer is None:
+            self.idle_timer = loop.call_at(self.last_activity + self.idle_timeout, self.__on_idle)
+
+        self.reading = True
+        try:
+            data = await self.reader.read(_BUFFER_SIZE)
+        finally:
+            self.reading = False
+            self.last_activity = loop.time()
+        if self.timed_out:
+            raise asyncio.TimeoutError
+        return data
+
+    def __on_idle(self):
+        loop = asyncio.get_running_loop()
+        if not self.reading:  # the connection is busy sending, check again later
+            self.idle_timer = loop.call_at(loop.time() + self.idle_timeout, self.__on_idle)
+            return
+        if loop.time() - self.last_activity < self.idle_timeout:
+            # there was data since the timer was set, wait for the rest of the timeout
+            self.idle_timer = loop.call_at(self.last_activity + self.idle_timeout, self.__on_idle)
+            return
+        self.timed_out = True
+        self.idle_timer = None
+        self.writer.close()  # wakes the pending read
+
+    def __stop_timer(self):
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+
+    def close(self):
+        self.__stop_timer()
+
+
+if __name__ == '__main__':
+    from random import Random
+    import time
+
+    def random_messages(rnd: Random, count: int, num_pieces: int):
+        messages = []
+        for _ in range(count):
+            kind = rnd.choice([INTERESTED, NOT_INTERESTED, HAVE, REQUEST, CANCEL, CHOKE, None])
+            if kind == INTERESTED:
+                messages.append((Interested.encode(), ('interested',)))
+            elif kind == NOT_INTERESTED:
+                messages.append((NotInterested.encode(), ('not interested',)))
+            elif kind == HAVE:
+                index = rnd.randrange(num_pieces)
+                messages.append((Have.encode(index), ('have', index)))
+            elif kind in (REQUEST, CANCEL):
+                params = rnd.randrange(num_pieces), rnd.randrange(0, 2 ** 20, BLOCK_SIZE), BLOCK_SIZE
+                message = Request if kind == REQUEST else Cancel
+                messages.append((message.encode(*params), (message.__name__.lower(), *params)))
+            elif kind == CHOKE:
+                messages.append((Chock.encode(), None))  # skipped by the stream
+            else:
+                messages.append((b'\x00\x00\x00\x00', None))  # keepalive
+        return messages
+
+    def describe(msg) -> tuple:
+        if isinstance(msg, Interested):
+            return 'interested',
+        if isinstance(msg, NotInterested):
+            return 'not interested',
+        if isinstance(msg, Have):
+            return 'have', msg.piece_index
+        return type(msg).__name__.lower(), msg.piece_index, msg.begin, msg.length
+
+    class NullWriter:
+        def close(self):
+            pass
+
+    async def decode(chunks, num_pieces: int):
+        reader = asyncio.StreamReader()
+        for chunk in chunks:
+            reader.feed_data(chunk)
+        reader.feed_eof()
+        stream = Stream(reader, NullWriter(), num_pieces)
+        return [describe(msg) async for msg in stream]
+
+    def fragment(rnd: Random, data: bytes, max_size: int):
+        chunks, index = [], 0
+        while index < len(data):
+            size = rnd.randint(1, max_size)
+            chunks.append(data[index:index + size])
+            index += size
+        return chunks
+
+    async def main():
+        # fuzz: random messages cut at random places must decode to the same messages
+        rnd = Random(40)
+        for _ in range(500):
+            messages = random_messages(rnd, rnd.randint(1, 200), 1000)
+            data = b''.join(raw for raw, _ in messages)
+            expected = [msg for _, msg in messages if msg is not None]
+            assert await decode(fragment(rnd, data, rnd.choice([1, 3, 17, 4096])), 1000) == expected
+
+        # fuzz: garbage must be refused, never hang
+        for _ in range(500):
+            garbage = bytes(rnd.getrandbits(8) for _ in range(rnd.randint(5, 64)))
+            try:
+                await asyncio.wait_for(decode(fragment(rnd, garbage, 8), 1000), 1)
+            except (AssertionError, struct.error):
+                pass
+
+        # a partial message must wait for the rest of it instead of spinning
+        reader = asyncio.StreamReader()
+        reader.feed_data(Request.encode(1, 0)[:9])
+        stream = Stream(reader, NullWriter(), 10, idle_timeout=0.2)
+        pending = asyncio.create_task(stream.__anext__())
+        await asyncio.sleep(0.05)
+        assert not pending.done()
+        reader.feed_data(Request.encode(1, 0)[9:])
+        assert describe(await pending) == ('request', 1, 0, BLOCK_SIZE)
+        stream.close()
+
+        # an idle leecher is closed by the timer
+        class ClosingWriter:
+            def close(self):
+                reader.feed_eof()
+        reader = asyncio.StreamReader()
+        stream = Stream(reader, ClosingWriter(), 10, idle_timeout=0.1)
+        try:
+            await asyncio.wait_for(stream.__anext__(), 1)
+            raise Exception('idle leecher was not closed')
+        except asyncio.TimeoutError:
+            assert stream.timed_out
+        print('fuzz passed')
+
+        # benchmark: a pipelined burst of requests in read sized chunks
+        messages = random_messages(Random(1), 200_000, 1000)
+        data = b''.join(raw for raw, _ in messages)
+        chunks = [data[i:i + _BUFFER_SIZE] for i in range(0, len(data), _BUFFER_SIZE)]
+        start = time.perf_counter()
+        decoded = await decode(chunks, 1000)
+        elapsed = time.perf_counter() - start
+        print(f'{len(decoded) / elapsed:,.0f} messages/s, {len(data) / elapsed / 2 ** 20:,.1f} MiB/s')
+
+    asyncio.run(main())
@@ -0,0 +1,133 @@
+from src.peer.message_types import Have
+from src.seeding.leecher_object import Leecher
+
+from collections import defaultdict
+from typing import Dict, List, Set, Union
+from random import random
+import bitstring
+
+
+_MAX_OFFERS = 2  # pieces a leecher may be offered at once and not have yet
+
+
+class SuperSeed(object):
+    """
+    super-seeding state of one torrent (BEP 16)
+    every leecher sees a single piece at a time, chosen among the ones the swarm has the least.
+    the leecher gets a new piece once the one it was shown reaches another peer
+    (or once it has downloaded it itself), so our upload goes into distinct pieces
+    """
+
+    def __init__(self, num_pieces: int):
+        self.num_pieces = num_pieces
+        self.availability: List[int] = [0] * num_pieces  # leechers that have each piece
+        self.revealed_count: List[int] = [0] * num_pieces  # times each piece was revealed
+        self.revealed_to: Dict[int, Set[Leecher]] = defaultdict(set)  # piece -> leechers it was revealed to
+
+    def connect(self, leecher: Leecher):
+        self.reveal(leecher)
+
+    def disconnect(self, leecher: Leecher):
+        if leecher.bitfield is not None:
+            for index in leecher.bitfield.findall('0b1'):
+                self.availability[index] -= 1
+        for index in leecher.revealed:
+            if leecher.bitfield is None or not leecher.bitfield[index]:  # the offer was never taken
+                self.revealed_count[index] -= 1
+            self.__withdraw(leecher, index)
+
+    def report_bitfield(self, leecher: Leecher, bitfield: bitstring.BitArray):
+        if leecher.bitfield is not None:  # only one bitfield is allowed
+            return
+        leecher.bitfield = bitfield
+        for index in bitfield.findall('0b1'):
+            self.availability[index] += 1
+            self.__propagated(leecher, index)
+
+        if all(bitfield[index] for index in leecher.revealed):  # it had what we showed it
+            self.reveal(leecher)
+
+    def report_have(self, leecher: Leecher, piece_index: int):
+        if leecher.bitfield is None:
+            leecher.bitfield = bitstring.BitArray(self.num_pieces)
+        if leecher.bitfield[piece_index]:
+            return
+        leecher.bitfield[piece_index] = True
+        self.availability[piece_index] += 1
+        self.__propagated(leecher, piece_index)
+
+        if piece_index in leecher.revealed:  # it downloaded what we showed it
+            self.reveal(leecher)
+
+    def report_unoffered_request(self, leecher: Leecher):
+        """
+        the leecher requested a piece it wasn't offered, the request isn't served.
+        it may not want what it was offered, so another piece is offered, up to a few at once
+        """
+        offers = sum(1 for index in leecher.revealed if leecher.bitfield is None or not leecher.bitfield[index])
+        if offers < _MAX_OFFERS:
+            self.reveal(leecher)
+
+    def reveal(self, leecher: Leecher) -> Union[int, None]:
+        """
+        advertises the rarest piece the leecher doesn't have
+        :return: piece index, None if it has everything
+        """
+        rarest = None
+        rarest_key = None
+        for index in range(self.num_pieces):
+            if index in leecher.revealed or (leecher.bitfield is not None and leecher.bitfield[index]):
+                continue
+            key = (self.availability[index] + self.revealed_count[index], random())
+            if rarest_key is None or key < rarest_key:
+                rarest, rarest_key = index, key
+
+        if rarest is not None:
+            leecher.revealed.add(rarest)
+            self.revealed_count[rarest] += 1
+            self.revealed_to[rarest].add(leecher)
+            leecher.send(Have.encode(rarest))  # the leecher may be another connection, in the middle of a block
+        return rarest
+
+    def __propagated(self, leecher: Leecher, piece_index: int):
+        # whoever we revealed the piece to passed it on, show them a new one
+        for other in list(self.revealed_to.get(piece_index, ())):
+            if other is not leecher and not other.writer.is_closing():
+                self.__withdraw(other, piece_index)
+                self.reveal(other)
+
+    def __withdraw(self, leecher: Leecher, piece_index: int):
+        leechers = self.revealed_to.get(piece_index)
+        if leechers is not None:
+            leechers.discard(leecher)
+            if not leechers:
+                del self.revealed_to[piece_index]
+
+
+class SuperSeeder(object):
+    """
+    super-seeding state of every torrent we seed
+    """
+
+    def __init__(self):
+        self.torrents: Dict[bytes, SuperSeed] = dict()
+        self.leechers: Dict[bytes, int] = defaultdict(int)  # connected leechers per torrent
+
+    def connect(self, info_hash: bytes, num_pieces: int, leecher: Leecher) -> SuperSeed:
+        if info_hash not in self.torrents:
+            self.torrents[info_hash] = SuperSeed(num_pieces)
+        self.leechers[info_hash] += 1
+        self.torrents[info_hash].connect(leecher)
+        return self.torrents[info_hash]
+
+    def disconnect(self, info_hash: bytes, leecher: Leecher):
+        if info_hash not in self.torrents:
+            return
+        self.torrents[info_hash].disconnect(leecher)
+        self.leechers[info_hash] -= 1
+        if self.leechers[info_hash] <= 0:
+            del self.leechers[info_hash]
+            del self.torrents[info_hash]
+
+
+SUPER_SEEDER = SuperSeeder()
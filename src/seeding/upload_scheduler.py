@@ -0,0 +1,172 @@
+import src.app_data.db_utils as db_utils
+from src.peer.message_types import Piece
+from src.seeding.leecher_object import Leecher
+from src.file.file_object import PickableFile
+from src.file.fd_pool import FILE_POOL
+
+from collections import deque
+from typing import Deque, Set, Tuple
+import asyncio
+import time
+
+
+_QUANTUM = 2 ** 14 * 4  # bytes a leecher may send per round, 4 blocks
+_BURST_TIME = 1  # seconds of upload the bucket can save up
+_COMPACT_SLACK = 64  # cancelled requests kept in the deque before it is rebuilt
+
+
+async def send_piece(leecher: Leecher, piece_index: int, begin: int, length: int):
+    """
+    sends a piece message without copying the block through python:
+    the 13 bytes header is written first, then every file span of the block goes through sendfile
+    (falls back to read and write where the transport can't use it).
+    other messages to the leecher are held until the block was sent, writing during sendfile fails
+    """
+    loop = asyncio.get_running_loop()
+    file_object: PickableFile = leecher.file_object
+    leecher.writer.write(Piece.encode_header(piece_index, begin, length))
+    leecher.in_sendfile = True
+    try:
+        for file_name, offset, span in file_object.block_spans(piece_index, begin, length):
+            with FILE_POOL.open(file_name, file_object.flags) as fd, open(fd, 'rb', buffering=0, closefd=False) as file:
+                await loop.sendfile(leecher.writer.transport, file, offset, span)
+    finally:
+        leecher.release_held()
+
+
+class TokenBucket(object):
+    """
+    global upload budget in bytes, refilled at the upload rate
+    a rate of 0 means unlimited
+    """
+
+    def __init__(self, rate: int):
+        self.rate = rate  # in bytes/s
+        self.tokens = rate * _BURST_TIME
+        self.last_refill = time.monotonic()
+
+    async def consume(self, amount: int):
+        if not self.rate:
+            return
+        rn = time.monotonic()
+        self.tokens = min(self.tokens + (rn - self.last_refill) * self.rate, self.rate * _BURST_TIME)
+        self.last_refill = rn
+
+        # take the tokens up front and wait for the debt, concurrent senders queue up behind each other
+        self.tokens -= amount
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+class UploadScheduler(object):
+    """
+    serves the requests of every unchoked leecher, deficit round robin
+    each round a leecher gets a quantum of bytes to send, so leechers that request big blocks
+    don't starve the others. sends are paced by one upload budget shared by all connections.
+    a leecher is in the round only while it has requests and isn't in the middle of sending
+    """
+
+    def __init__(self, max_upload_rate: int):
+        """
+        :param max_upload_rate: in KiB/s, 0 for unlimited
+        """
+        self.bucket = TokenBucket((max_upload_rate or 0) * 1024)
+        self.active: Deque[Leecher] = deque()  # leechers waiting for their turn
+        self.ready = asyncio.Event()
+        self.sending_tasks: Set[asyncio.Task] = set()  # the loop only keeps weak references to its tasks
+
+    def enqueue(self, leecher: Leecher, request: Tuple[int, int, int]):
+        if request in leecher.pending_requests:
+            return
+        leecher.pending_requests.add(request)
+        leecher.pipelined_requests.append(request)
+        self.__activate(leecher)
+
+    @staticmethod
+    def cancel(leecher: Leecher, request: Tuple[int, int, int]):
+        # the request stays in the deque and is skipped when it comes up
+        leecher.pending_requests.discard(request)
+        if len(leecher.pipelined_requests) > 2 * len(leecher.pending_requests) + _COMPACT_SLACK:
+            leecher.pipelined_requests = deque(x for x in leecher.pipelined_requests if x in leecher.pending_requests)
+
+    @staticmethod
+    def clear(leecher: Leecher):
+        leecher.pending_requests.clear()
+        leecher.pipelined_requests.clear()
+        leecher.deficit = 0
+
+    async def loop(self):
+        while True:
+            await self.ready.wait()
+            if not self.active:
+                self.ready.clear()
+                continue
+
+            leecher = self.active.popleft()
+            leecher.scheduled = False
+            if not self.__can_send(leecher):
+                leecher.deficit = 0
+                continue
+
+            leecher.deficit += _QUANTUM
+            batch = []
+            while leecher.pipelined_requests:
+                request = leecher.pipelined_requests[0]
+                if request not in leecher.pending_requests:  # cancelled
+                    leecher.pipelined_requests.popleft()
+                    continue
+                if request[2] > leecher.deficit:
+                    break
+                leecher.pipelined_requests.popleft()
+                leecher.pending_requests.discard(request)
+                leecher.deficit -= request[2]
+                batch.append(request)
+
+            if not leecher.pending_requests:  # the deficit isn't kept by idle leechers
+                leecher.deficit = 0
+
+            if batch:
+                leecher.sending = True
+                task = asyncio.create_task(self.__send_batch(leecher, batch))
+                self.sending_tasks.add(task)
+                task.add_done_callback(self.__batch_sent)
+            else:
+                self.__activate(leecher)
+
+            await asyncio.sleep(0)  # let the sends start
+
+    async def __send_batch(self, leecher: Leecher, batch):
+        try:
+            for piece_index, begin, length in batch:
+                await self.bucket.consume(length)
+                if leecher.am_chocked or leecher.writer.is_closing():
+                    break
+                await send_piece(leecher, piece_index, begin, length)
+                # update statistics
+                leecher.file_object.uploaded += length
+                leecher.downloaded += length
+                leecher.update_download_rate(length)
+        except Exception as e:
+            print(f'An error occurred: {e}')
+            leecher.writer.close()
+        finally:
+            leecher.sending = False
+            self.__activate(leecher)
+
+    def __batch_sent(self, task: asyncio.Task):
+        self.sending_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f'failed to send a batch: {task.exception()!r}')
+
+    def __activate(self, leecher: Leecher):
+        if not leecher.scheduled and not leecher.sending and self.__can_send(leecher):
+            leecher.scheduled = True
+            self.active.append(leecher)
+            self.ready.set()
+
+    @staticmethod
+    def __can_send(leecher: Leecher) -> bool:
+        return bool(leecher.pending_requests) and not leecher.am_chocked and leecher in Leecher.leecher_instances
+
+
+UPLOAD_SCHEDULER = UploadScheduler(db_utils.get_configuration('max_upload_rate'))
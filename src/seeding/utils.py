@@ -1,14 +1,11 @@
 import src.app_data.db_utils as db_utils
-from src.file.file_object import PickableFile
+from src.peer.canonical_priority import set_external_ip
 
 import upnpclient
 import socket
+import ipaddress
 from typing import Union, Tuple, Dict
 import time
-import crc32c
-
-
-FileObjects: Dict[bytes, PickableFile] = dict()
 
 
 async def save_forward(internal_port: int, external_port: int, version: str):
@@ -40,21 +37,28 @@ def load_forwarding(version: str) -> Tuple[int, int, float]:
 
 
 def get_internal_ip() -> Union[Tuple[str, str], Tuple[None, None]]:
+    """
+    :return: this machine's ipv4 in the NAT, this machine's global ipv6 (None if it has no ipv6 connectivity)
+    """
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         s.connect(('8.8.8.8', 8888))  # some address
         nat_ipv4 = s.getsockname()[0]
         s.close()
-        '''
+    except:
+        nat_ipv4 = None
+
+    try:
         s = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
         s.connect(('2001:4860:4860::8888', 53))  # some IPv6 address
         nat_ipv6 = s.getsockname()[0]
         s.close()
-        return nat_ipv4, nat_ipv6
-        '''
-        return nat_ipv4, None
+        if not ipaddress.ip_address(nat_ipv6).is_global:  # link-local or unique local, unreachable from outside
+            nat_ipv6 = None
     except:
-        return None, None
+        nat_ipv6 = None
+
+    return nat_ipv4, nat_ipv6
 
 
 async def forward_port_upnp(devices, external_port: int, internal_port: int, protocol: str, nat_ip: str, lease_duration: int) -> bool:
@@ -76,6 +80,7 @@ async def forward_port_upnp(devices, external_port: int, internal_port: int, pro
             # get external ip before sending SOAP
             external_ip = d.WANIPConn1.GetExternalIPAddress()['NewExternalIPAddress']
             await db_utils.set_configuration('external_ip', external_ip)
+            set_external_ip(external_ip)
 
             d.WANIPConn1.AddPortMapping(NewRemoteHost='0.0.0.0',
                                         NewExternalPort=external_port,
@@ -91,37 +96,3 @@ async def forward_port_upnp(devices, external_port: int, internal_port: int, pro
             pass
 
     return success
-
-
-def crc32c_sort_v4(peer_ip: str):
-    external_ip = db_utils.get_configuration('external_ip')
-    octets = peer_ip.split('.')
-    peer_ip = ''.join([bin(int(octet))[2:].zfill(8) for octet in octets])
-    octets = external_ip.split('.')
-    external_ip = ''.join([bin(int(octet))[2:].zfill(8) for octet in octets])
-
-    for mask_length, bits in enumerate(zip(peer_ip, external_ip)):
-        bit1, bit2 = bits
-        if bit1 != bit2:
-            break
-
-    if mask_length < 16:
-        mask = 4294923605  # FF.FF.55.55
-    elif 16 <= mask_length < 24:
-        mask = 4294967125  # FF.FF.FF.55
-    else:
-        mask = 4294967295  # FF.FF.FF.FF
-
-    masked_peer_ip = int(peer_ip, 2) & mask
-    masked_external_ip = int(external_ip, 2) & mask
-
-    sorted_ip = sorted([masked_external_ip, masked_peer_ip])
-    joined_ip = int(''.join([bin(ip)[2:].zfill(32) for ip in sorted_ip]), 2)
-    priority = crc32c.crc32c(str(joined_ip).encode())
-    return priority
-
-
-
-
-
-
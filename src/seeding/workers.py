@@ -0,0 +1,189 @@
+import src.app_data.db_utils as db_utils
+from src.app_data.ip_filter import IP_FILTER
+from src.seeding.acceptor import ACCEPTOR
+from src.seeding.registry import SEEDING_REGISTRY
+from src.seeding.leecher_object import Leecher
+from src.seeding.choker import SEED_CHOKER
+from src.seeding.admission import ADMISSION
+from src.seeding.upload_scheduler import UPLOAD_SCHEDULER, TokenBucket
+
+from typing import List, Tuple, Dict, Union
+from collections import defaultdict
+import multiprocessing
+import asyncio
+import socket
+import pickle
+import queue
+
+
+_STATS_INTERVAL = 5  # seconds between upload statistics reports of a worker
+_QUEUE_TIMEOUT = 1  # the queue readers wake up to let the loop shut down
+_MAX_HANDOFF_SIZE = 1024  # pickled address and handshake of a handed over connection
+
+# set in a seeding worker process: events to the main process
+_EVENTS: Union[multiprocessing.Queue, None] = None
+
+
+def workers_supported() -> bool:
+    # SO_REUSEPORT and descriptor passing, not available on windows
+    return hasattr(socket, 'SO_REUSEPORT') and hasattr(socket, 'send_fds')
+
+
+def _share(total: int, index: int, processes: int) -> int:
+    # the remainder goes to the first processes, so the shares add up to the total
+    return total // processes + (1 if index < total % processes else 0)
+
+
+def split_limits(index: int, processes: int):
+    """
+    applies this process' share of the configured seeding limits, every process enforces its own
+    :param index: 0 for the main process, 1... for the workers
+    :param processes: seeding processes, including the main one
+    """
+    SEED_CHOKER.upload_slots = max(_share(db_utils.get_configuration('max_upload_slots'), index, processes), 1)
+    ADMISSION.max_leechers = max(_share(db_utils.get_configuration('max_leecher_peers'), index, processes), 1)
+    ADMISSION.max_per_subnet = max(_share(db_utils.get_configuration('max_leechers_per_subnet'), index, processes), 1)
+    UPLOAD_SCHEDULER.bucket = TokenBucket((db_utils.get_configuration('max_upload_rate') or 0) * 1024 / processes)
+
+
+class SeedingWorkers(object):
+    """
+    seeding worker processes of the main process
+    every worker is a spawned interpreter that loads the torrents to seed itself
+    and accepts on the same ports as the main process with SO_REUSEPORT, the kernel spreads the connections.
+    workers send bans and upload statistics to the main process through a queue, connections of torrents
+    they don't seed are handed back to the main process over a unix socket (the main process runs the downloads)
+    """
+
+    def __init__(self):
+        self.processes: List[multiprocessing.Process] = []
+        self.commands: List[multiprocessing.Queue] = []  # per worker
+        self.channels: List[socket.socket] = []  # per worker, main process side
+        self.events: Union[multiprocessing.Queue, None] = None
+        self.uploaded: Dict[bytes, int] = defaultdict(int)  # bytes uploaded by the workers, per torrent
+
+    def start(self, workers: int, servers: List[socket.socket]):
+        """
+        call before the main process serves anyone
+        :param workers: number of processes to start
+        :param servers: listening sockets of the main process, opened with SO_REUSEPORT
+        """
+        addresses = [server.getsockname()[:2] for server in servers]
+        # the main process already runs threads and event loops, forking it would copy their state
+        context = multiprocessing.get_context('spawn')
+        self.events = context.Queue()
+        loop = asyncio.get_running_loop()
+        for index in range(workers):
+            commands = context.Queue()
+            channel, worker_channel = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+            process = context.Process(target=_worker_main, args=(index, workers + 1, addresses, self.events, commands, worker_channel),
+                                      name=f'RaBit-seeder-{index}', daemon=True)
+            process.start()
+            worker_channel.close()
+
+            channel.setblocking(False)
+            loop.add_reader(channel.fileno(), self.__receive_connection, channel)
+            self.processes.append(process)
+            self.commands.append(commands)
+            self.channels.append(channel)
+        db_utils.BAN_LISTENERS.append(self.broadcast_ban)
+
+    def broadcast_ban(self, ip: str):
+        # thread safe, bans come from the download threads as well
+        for commands in self.commands:
+            commands.put(('ban', ip))
+
+    async def loop(self):
+        while True:
+            try:
+                event = await asyncio.to_thread(self.events.get, timeout=_QUEUE_TIMEOUT)
+            except queue.Empty:
+                continue
+            if event[0] == 'ban':
+                db_utils.ban_peer(event[1])
+            elif event[0] == 'uploaded':
+                _, info_hash, uploaded = event
+                self.uploaded[info_hash] += uploaded
+                file_object = SEEDING_REGISTRY.get(info_hash)
+                if file_object is not None:
+                    file_object.uploaded += uploaded
+
+    def stop(self):
+        if self.broadcast_ban in db_utils.BAN_LISTENERS:
+            db_utils.BAN_LISTENERS.remove(self.broadcast_ban)
+        loop = asyncio.get_running_loop()
+        for channel in self.channels:
+            loop.remove_reader(channel.fileno())
+            channel.close()
+        for process in self.processes:
+            process.terminate()
+        self.processes, self.commands, self.channels = [], [], []
+
+    @staticmethod
+    def __receive_connection(channel: socket.socket):
+        try:
+            payload, fds, _, _ = socket.recv_fds(channel, _MAX_HANDOFF_SIZE, 1)
+        except BlockingIOError:
+            return
+        if not fds:
+            return
+        address, data = pickle.loads(payload)
+        ACCEPTOR.route(socket.socket(fileno=fds[0]), address, data)
+
+
+def _worker_main(index: int, processes: int, addresses: List[Tuple[str, int]], events: multiprocessing.Queue, commands: multiprocessing.Queue, channel: socket.socket):
+    # a fresh interpreter (spawn): no loop, thread, database connection or descriptor of the main process exists here
+    global _EVENTS
+    _EVENTS = events
+    db_utils.set_ban_forwarder(lambda ip: events.put(('ban', ip)))
+
+    try:
+        asyncio.run(_serve(index, processes, addresses, commands, channel))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _serve(index: int, processes: int, addresses: List[Tuple[str, int]], commands: multiprocessing.Queue, channel: socket.socket):
+    from src.seeding.server import handle_leecher, _REGISTRY_REFRESH_INTERVAL
+
+    def hand_over(conn: socket.socket, address: Tuple, data: bytes):
+        # the main process routes connections of ongoing downloads
+        try:
+            socket.send_fds(channel, [pickle.dumps((address, data))], [conn.fileno()])
+        finally:
+            conn.close()
+
+    async def command_loop():
+        while True:
+            try:
+                command = await asyncio.to_thread(commands.get, timeout=_QUEUE_TIMEOUT)
+            except queue.Empty:
+                continue
+            if command[0] == 'ban':
+                # the main process saved the ban, this process only needs to know it
+                IP_FILTER.add_ip(command[1])
+                for leecher in list(Leecher.leecher_instances):
+                    if leecher.address[0] == command[1]:
+                        leecher.writer.close()
+
+    async def stats_loop():
+        reported: Dict[bytes, int] = defaultdict(int, {info_hash: file_object.uploaded for info_hash, file_object in SEEDING_REGISTRY.torrents.items()})
+        while True:
+            await asyncio.sleep(_STATS_INTERVAL)
+            for info_hash, file_object in list(SEEDING_REGISTRY.torrents.items()):
+                if (uploaded := file_object.uploaded - reported[info_hash]) > 0:
+                    _EVENTS.put(('uploaded', info_hash, uploaded))
+                    reported[info_hash] = file_object.uploaded
+
+    await asyncio.to_thread(SEEDING_REGISTRY.load)
+    split_limits(index + 1, processes)
+    ACCEPTOR.seeding_handler = handle_leecher
+    ACCEPTOR.fallback = hand_over
+    servers = [ACCEPTOR.listen(host, port, reuse_port=True) for host, port in addresses]
+    print(f'seeding worker {index} is up')
+
+    await asyncio.gather(*[ACCEPTOR.serve_forever(server) for server in servers], command_loop(), stats_loop(),
+                         SEEDING_REGISTRY.refresh_loop(_REGISTRY_REFRESH_INTERVAL), SEED_CHOKER.loop(), UPLOAD_SCHEDULER.loop())
+
+
+SEEDING_WORKERS = SeedingWorkers()
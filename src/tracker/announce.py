@@ -1,69 +1,74 @@
 from .tracker_object import Tracker
-from .udp_tracker import udp_tracker_announce
-from .http_tracker import http_tracker_announce
 from src.torrent.torrent_object import Torrent
 
 import asyncio
-from typing import List, Tuple
-import time
-import math
+from typing import List, Tuple, Set, AsyncIterator
+import random
 
 
-async def initial_announce(TorrentData: Torrent, downloaded: int, uploaded: int, left: int, port: int, event: int) -> Tuple[List[Tuple[str, int]], List[Tracker]]:
-    """
-    performs announce request to trackers
-    :param TorrentData: a torrent object from torrent file
-    :param downloaded: bytes downloaded
-    :param uploaded: bytes uploaded
-    :param left: bytes left to download
-    :param port: port the client is listening on
-    :param event: 0: none; 1: completed; 2: started; 3: stopped
-    :return: a list of peer addresses (ip, port)
-    """
-    # TODO add tracker object support, scrape and updating udp trackers by protocol timeouts
-    # initial announce
-    if not TorrentData.announce_list:
-        TorrentData.announce_list = [[TorrentData.announce]]
-
-    peers_list: List[Tuple[str, int]] = []
-    tracker_list: List[Tracker] = []
+_INITIAL_TIMEOUTS = (2, 4)  # udp timeouts of the first announce, an unresponsive tracker passes its turn to the next in the tier
 
-    async def _announce(tracker_url) -> None:
-        nonlocal peers_list
-        nonlocal tracker_list
 
-        response = ''
-        tracker_url = tracker_url[0].decode('utf-8')
-        tracker_object = Tracker(tracker_url, TorrentData.info_hash, TorrentData.peer_id)
-        tracker_list.append(tracker_object)
-
-        try:
-            if 'udp' in tracker_url:
-                response = await udp_tracker_announce(tracker_url, TorrentData.info_hash, TorrentData.peer_id, downloaded, uploaded, left, event, port, timeout_list=[1, 1])  # set manual timeout_list to prevent blocking for now
-
-            elif 'http' in tracker_url:
-                response = await http_tracker_announce(tracker_url, TorrentData.info_hash, TorrentData.peer_id, downloaded, uploaded, left, event, port)
+class Announcer(object):
+    """
+    announces a torrent to its trackers by tiers (BEP 12)
+    the trackers of a tier are shuffled once and tried in order until one answers, the tracker that answered
+    moves to the front of its tier. the tiers are announced to at the same time and peers are delivered
+    as each tracker answers, so the download doesn't wait for the slowest tracker
+    """
 
-            if not isinstance(response, str):  # extend peer_list if an error message is not returned
-                peers_list.extend(response[0])
-                tracker_object.interval = response[1]
-                tracker_object.state = 'working'
-                tracker_object.last_announce = time.time()
-            else:
-                raise
+    def __init__(self, TorrentData: Torrent):
+        self.info_hash = TorrentData.info_hash
+        announce_list = TorrentData.announce_list or [[TorrentData.announce]]
 
-        except Exception as e:
-            tracker_object.interval = math.inf
-            tracker_object.state = 'unreachable'
-            tracker_object.last_announce = time.time()
+        self.tiers: List[List[Tracker]] = []
+        for tier in announce_list:
+            urls = list(dict.fromkeys(url.decode('utf-8') if isinstance(url, bytes) else url for url in tier if url))
+            random.shuffle(urls)
+            if urls:
+                self.tiers.append([Tracker(url, TorrentData.info_hash, TorrentData.peer_id) for url in urls])
 
-        return
+        self.seen: Set[Tuple[str, int]] = set()  # peers already delivered
 
-    tasks = [_announce(url) for url in TorrentData.announce_list]
+    @property
+    def trackers(self) -> List[Tracker]:
+        return [tracker for tier in self.tiers for tracker in tier]
 
-    await asyncio.gather(*tasks)
+    async def announce(self, downloaded: int, uploaded: int, left: int, event: int, timeout_list: List[int] = _INITIAL_TIMEOUTS) \
+            -> AsyncIterator[List[Tuple[str, int]]]:
+        """
+        announces to every tier
+        :param downloaded: bytes downloaded
+        :param uploaded: bytes uploaded
+        :param left: bytes left to download
+        :param event: 0: none; 1: completed; 2: started; 3: stopped
+        :param timeout_list: udp retransmission timeouts
+        :return: yields the new peer addresses (ip, port) of every tracker that answers
+        """
+        results: asyncio.Queue = asyncio.Queue()
+        tasks = [asyncio.create_task(self.__announce_tier(tier, results, downloaded, uploaded, left, event, timeout_list)) for tier in self.tiers]
 
-    # remove duplicates from peers[]
-    peers_list = list(dict.fromkeys(peers_list))
+        try:
+            for _ in tasks:
+                peers = await results.get()
+                peers = [peer for peer in dict.fromkeys(peers) if peer not in self.seen]
+                self.seen.update(peers)
+                if peers:
+                    yield peers
+            await asyncio.gather(*tasks)  # the trackers that answered are still scraped
+        finally:
+            for task in tasks:
+                task.cancel()
 
-    return peers_list, tracker_list
+    async def __announce_tier(self, tier: List[Tracker], results: asyncio.Queue, downloaded: int, uploaded: int, left: int, event: int, timeout_list: List[int]):
+        for tracker in list(tier):
+            peers = await tracker.re_announce(downloaded, uploaded, left, event, timeout_list)
+            if tracker.state == 'working':
+                results.put_nowait(peers)
+                # promote the tracker that answered
+                tier.remove(tracker)
+                tier.insert(0, tracker)
+                # learn the size of the swarm
+                await tracker.scrape()
+                return
+        results.put_nowait([])
@@ -1,13 +1,68 @@
-from .utils import format_announce_response
+from .utils import decode_compact_peers
+from .resolver import TrackerResolver
 from urllib.parse import urlencode
 import bencodepy
 from collections import OrderedDict
-from typing import Union, List, Tuple, Any, Iterable
+from typing import Union, List, Tuple, Any, Iterable, Dict
 import asyncio
 import aiohttp
+import weakref
 from yarl import URL
 
 
+_MAX_CONNECTIONS = 64
+_MAX_CONNECTIONS_PER_HOST = 4
+_KEEPALIVE_TIMEOUT = 60  # idle connections to a tracker are kept for the next announce
+_TIMEOUT = aiohttp.ClientTimeout(total=15, sock_connect=5)
+_MAX_RESPONSE_SIZE = 2 ** 21  # 2 MiB, after decompression
+_HEADERS = {
+    'User-Agent': 'RaBit v0.1.0',
+    'Accept-Encoding': 'gzip'
+}
+
+# one session per event loop, every torrent announcing from that loop shares its connection pool
+_SESSIONS: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aiohttp.ClientSession]' = weakref.WeakKeyDictionary()
+
+
+def get_session() -> aiohttp.ClientSession:
+    """
+    :return: the tracker session of the running event loop
+    """
+    loop = asyncio.get_running_loop()
+    session = _SESSIONS.get(loop)
+    if session is None or session.closed:
+        # hosts are cached by the shared resolver, for every session
+        connector = aiohttp.TCPConnector(limit=_MAX_CONNECTIONS, limit_per_host=_MAX_CONNECTIONS_PER_HOST,
+                                         keepalive_timeout=_KEEPALIVE_TIMEOUT, resolver=TrackerResolver(), use_dns_cache=False)
+        session = aiohttp.ClientSession(connector=connector, headers=_HEADERS, timeout=_TIMEOUT)
+        _SESSIONS[loop] = session
+    return session
+
+
+async def close_session():
+    """
+    closes the tracker session of the running event loop, call before the loop ends
+    """
+    session = _SESSIONS.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+async def read_limited(response: aiohttp.ClientResponse, limit: int = _MAX_RESPONSE_SIZE) -> bytes:
+    """
+    reads a response body, refusing bodies larger than the limit (also when they are compressed)
+    :raises ValueError: the body is too large
+    """
+    if response.content_length is not None and response.content_length > limit:
+        raise ValueError('response too large')
+    data = bytearray()
+    async for chunk in response.content.iter_chunked(2 ** 16):
+        data += chunk
+        if len(data) > limit:
+            raise ValueError('response too large')
+    return bytes(data)
+
+
 async def http_tracker_announce(tracker_url: str, info_hash: bytes, peer_id: bytes, downloaded: int, uploaded: int, left: int, event: int, port: int) \
         -> Union[Tuple[List[Tuple[str, int]], int], str]:
     """
@@ -24,10 +79,6 @@ async def http_tracker_announce(tracker_url: str, info_hash: bytes, peer_id: byt
     """
     events = ['none', 'completed', 'started', 'stopped']
 
-    headers = {
-        'User-Agent': 'RaBit v0.1.0'
-    }
-
     params = {
         'info_hash': info_hash,
         'peer_id': peer_id,
@@ -41,27 +92,80 @@ async def http_tracker_announce(tracker_url: str, info_hash: bytes, peer_id: byt
     params = urlencode(params)
     tracker_url = f"{tracker_url}?{params}"
 
-    async with aiohttp.ClientSession(headers=headers) as session:
-        async with session.get(URL(tracker_url, encoded=True)) as response:
-            # check if the request was successful (HTTP status code 200)
-            if response.status == 200:
-                peer_data = await response.read()
-                peer_data = bencodepy.decode(peer_data)
-
-                try:
-                    return [(peer[b'ip'].decode('utf-8'), peer[b'port']) for peer in peer_data[b'peers']], peer_data[b'interval']
-
-                except TypeError:  # this means the tracker returned a compact response
-                    ipv4peers, ipv6peers = [], []
-                    data = peer_data.get(b'peers')
-                    if data:
-                        ipv4peers = format_announce_response(data, 'v4', '>', 0)[0]
-                    data = peer_data.get(b'peers6')
-                    if data:
-                        ipv6peers = format_announce_response(data, 'v6', '>', 0)[0]
-
-                    ipv4peers.extend(ipv6peers)
-                    return ipv4peers, peer_data[b'interval']
-
-            else:
-                return f"Failed to connect to the tracker. HTTP Status Code: {response.status}"
+    # the session of the loop is kept open, connections are reused by the next announces
+    session = get_session()
+    async with session.get(URL(tracker_url, encoded=True)) as response:
+        # check if the request was successful (HTTP status code 200)
+        if response.status == 200:
+            try:
+                peer_data = await read_limited(response)
+            except ValueError as e:
+                return f"Failed to read the tracker response: {e}"
+            peer_data = bencodepy.decode(peer_data)
+
+            try:
+                return [(peer[b'ip'].decode('utf-8'), peer[b'port']) for peer in peer_data[b'peers']], peer_data[b'interval']
+
+            except TypeError:  # this means the tracker returned a compact response
+                ipv4peers, ipv6peers = [], []
+                data = peer_data.get(b'peers')
+                if data:
+                    ipv4peers = decode_compact_peers(data, 'v4')
+                data = peer_data.get(b'peers6')
+                if data:
+                    ipv6peers = decode_compact_peers(data, 'v6')
+
+                ipv4peers.extend(ipv6peers)
+                return ipv4peers, peer_data[b'interval']
+
+        else:
+            return f"Failed to connect to the tracker. HTTP Status Code: {response.status}"
+
+
+def scrape_url(tracker_url: str) -> Union[str, None]:
+    """
+    derives the scrape url from the announce url (the last part of the path must start with 'announce')
+    :return: scrape url | None if the tracker doesn't support scrape
+    """
+    path, separator, name = tracker_url.rpartition('/')
+    if not separator or not name.startswith('announce'):
+        return None
+    return f"{path}/scrape{name[len('announce'):]}"
+
+
+async def http_tracker_scrape(tracker_url: str, info_hashes: List[bytes]) -> Union[Tuple[Dict[bytes, Tuple[int, int, int]], int], str]:
+    """
+    scrapes a http tracker for several torrents at once
+    :param tracker_url: announce url of the tracker
+    :param info_hashes: info_hashes of the torrents, keep the url short enough
+    :return: info_hash -> (seeders, leechers, completed), minimal interval between scrapes (0 if not given) | str: error message
+    """
+    url = scrape_url(tracker_url)
+    if url is None:
+        return "tracker doesn't support scrape"
+
+    params = urlencode([('info_hash', info_hash) for info_hash in info_hashes])
+    separator = '&' if '?' in url else '?'
+
+    session = get_session()
+    async with session.get(URL(f"{url}{separator}{params}", encoded=True)) as response:
+        if response.status != 200:
+            return f"Failed to scrape the tracker. HTTP Status Code: {response.status}"
+        try:
+            data = bencodepy.decode(await read_limited(response))
+        except (ValueError, bencodepy.DecodingError) as e:
+            return f"Failed to read the scrape response: {e}"
+
+    if not isinstance(data, dict) or b'failure reason' in data:
+        return "tracker refused the scrape"
+
+    files = data.get(b'files', dict())
+    results = dict()
+    for info_hash in info_hashes:
+        stats = files.get(info_hash)
+        if isinstance(stats, dict):
+            results[info_hash] = stats.get(b'complete', 0), stats.get(b'incomplete', 0), stats.get(b'downloaded', 0)
+
+    flags = data.get(b'flags')
+    min_interval = flags.get(b'min_request_interval', 0) if isinstance(flags, dict) else 0
+    return results, min_interval
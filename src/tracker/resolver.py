@@ -0,0 +1,87 @@
+from aiohttp.abc import AbstractResolver
+
+from typing import Dict, List, Tuple, Union
+import threading
+import asyncio
+import socket
+import weakref
+import time
+
+
+_POSITIVE_TTL = 300  # seconds a resolved host is trusted
+_NEGATIVE_TTL = 60  # a host that failed to resolve is not looked up again meanwhile
+
+
+class Resolver(object):
+    """
+    asynchronous getaddrinfo for the tracker clients
+    results (and failures) are cached for every download thread, and concurrent lookups of the same host
+    in an event loop wait for one query
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (host, port, family, type) -> addresses | error message, expiry
+        self.cache: Dict[Tuple[str, int, int, int], Tuple[Union[List[Tuple[int, Tuple]], str], float]] = dict()
+        # lookups in flight, per event loop
+        self.pending: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple, asyncio.Task]]' = weakref.WeakKeyDictionary()
+
+    async def resolve(self, host: str, port: int, family: int = socket.AF_UNSPEC, type: int = socket.SOCK_STREAM) -> List[Tuple[int, Tuple]]:
+        """
+        :param family: socket.AF_UNSPEC for both ip versions
+        :param type: socket.SOCK_STREAM | socket.SOCK_DGRAM
+        :return: list of (family, socket address)
+        :raises socket.gaierror: the host can't be resolved
+        """
+        key = host, port, family, type
+        with self.lock:
+            cached = self.cache.get(key)
+        if cached is None or cached[1] < time.monotonic():
+            loop = asyncio.get_running_loop()
+            pending = self.pending.setdefault(loop, dict())
+            if key not in pending:
+                pending[key] = loop.create_task(self.__lookup(key))
+            cached = await asyncio.shield(pending[key])
+
+        if isinstance(cached[0], str):
+            raise socket.gaierror(cached[0])
+        return cached[0]
+
+    async def __lookup(self, key: Tuple[str, int, int, int]) -> Tuple[Union[List[Tuple[int, Tuple]], str], float]:
+        host, port, family, type = key
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.getaddrinfo(host, port, family=family, type=type)
+            addresses = list(dict.fromkeys((res[0], res[4]) for res in result))
+            cached = addresses, time.monotonic() + _POSITIVE_TTL
+        except (socket.gaierror, UnicodeError) as e:
+            cached = str(e), time.monotonic() + _NEGATIVE_TTL
+        finally:
+            self.pending.get(loop, dict()).pop(key, None)
+
+        with self.lock:
+            now = time.monotonic()
+            for expired in [cache_key for cache_key, (_, expiry) in self.cache.items() if expiry < now]:
+                del self.cache[expired]
+            self.cache[key] = cached
+        return cached
+
+
+class TrackerResolver(AbstractResolver):
+    """
+    lets the http tracker sessions resolve through RESOLVER
+    """
+
+    async def resolve(self, host: str, port: int = 0, family: int = socket.AF_INET) -> List[Dict]:
+        try:
+            addresses = await RESOLVER.resolve(host, port, family)
+        except socket.gaierror as e:
+            raise OSError(f'failed to resolve {host}: {e}')
+        return [{'hostname': host, 'host': address[0], 'port': address[1], 'family': address_family, 'proto': 0,
+                 'flags': socket.AI_NUMERICHOST | socket.AI_NUMERICSERV} for address_family, address in addresses]
+
+    async def close(self):
+        pass
+
+
+RESOLVER = Resolver()
@@ -0,0 +1,108 @@
+from .http_tracker import http_tracker_scrape
+from .udp_tracker import udp_tracker_scrape, MAX_SCRAPE_HASHES
+
+from typing import Dict, List, Tuple, Union
+import threading
+import asyncio
+import time
+
+
+_SCRAPE_TTL = 30 * 60  # seconds a scrape result is trusted
+_FAILURE_TTL = 5 * 60  # a tracker that failed to scrape is not asked again meanwhile
+_HTTP_SCRAPE_HASHES = 50  # info_hashes per http scrape, keeps the url short
+_UDP_TIMEOUTS = (2, 4)  # a scrape is not worth waiting for the whole retransmission schedule
+
+
+class ScrapeResult(object):
+    __slots__ = ('seeders', 'leechers', 'completed', 'time')
+
+    def __init__(self, seeders: int, leechers: int, completed: int):
+        self.seeders = seeders
+        self.leechers = leechers
+        self.completed = completed
+        self.time = time.time()
+
+    @property
+    def dead(self) -> bool:
+        # nobody to download from or upload to
+        return self.seeders == 0 and self.leechers == 0
+
+    def __repr__(self):
+        return f"seeders: {self.seeders}, leechers: {self.leechers}, completed: {self.completed}"
+
+
+class ScrapeCache(object):
+    """
+    scrape results of every tracker, shared by all the downloads (each runs its own thread)
+    torrents missing from the cache are scraped in batches, as many info_hashes per request as the protocol allows
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.results: Dict[Tuple[str, bytes], Tuple[ScrapeResult, float]] = dict()  # (url, info_hash) -> result, expiry
+        self.failed: Dict[str, float] = dict()  # url -> expiry
+
+    def get(self, tracker_url: str, info_hash: bytes) -> Union[ScrapeResult, None]:
+        """
+        :return: the cached scrape result, None if unknown or expired
+        """
+        with self.lock:
+            cached = self.results.get((tracker_url, info_hash))
+        if cached is None or cached[1] < time.time():
+            return None
+        return cached[0]
+
+    async def scrape(self, tracker_url: str, info_hashes: List[bytes]) -> Dict[bytes, ScrapeResult]:
+        """
+        :param tracker_url: announce url of the tracker
+        :param info_hashes: torrents to scrape
+        :return: info_hash -> scrape result, torrents the tracker didn't report are missing
+        """
+        results = dict()
+        missing = []
+        for info_hash in dict.fromkeys(info_hashes):
+            result = self.get(tracker_url, info_hash)
+            if result is not None:
+                results[info_hash] = result
+            else:
+                missing.append(info_hash)
+
+        with self.lock:
+            if not missing or self.failed.get(tracker_url, 0) > time.time():
+                return results
+
+        batch_size = _HTTP_SCRAPE_HASHES if tracker_url.startswith('http') else MAX_SCRAPE_HASHES
+        batches = [missing[i:i + batch_size] for i in range(0, len(missing), batch_size)]
+        for response in await asyncio.gather(*[self.__scrape(tracker_url, batch) for batch in batches]):
+            results.update(response)
+        return results
+
+    async def __scrape(self, tracker_url: str, info_hashes: List[bytes]) -> Dict[bytes, ScrapeResult]:
+        ttl = _SCRAPE_TTL
+        try:
+            if tracker_url.startswith('http'):
+                response = await http_tracker_scrape(tracker_url, info_hashes)
+                if not isinstance(response, str):
+                    response, min_interval = response
+                    ttl = max(ttl, min_interval)
+            else:
+                response = await udp_tracker_scrape(tracker_url, info_hashes, timeout_list=_UDP_TIMEOUTS)
+        except Exception as e:
+            response = str(e)
+
+        with self.lock:
+            if isinstance(response, str):
+                self.failed[tracker_url] = time.time() + _FAILURE_TTL
+                return dict()
+
+            results = {info_hash: ScrapeResult(*stats) for info_hash, stats in response.items()}
+            now = time.time()
+            expiry = now + ttl
+            for key in [key for key, (_, key_expiry) in self.results.items() if key_expiry < now]:
+                del self.results[key]
+            for info_hash, result in results.items():
+                self.results[tracker_url, info_hash] = result, expiry
+            return results
+
+
+SCRAPE_CACHE = ScrapeCache()
@@ -2,9 +2,11 @@ import asyncio
 import math
 import time
 import threading
+from typing import List, Tuple, Union
 
 from .http_tracker import http_tracker_announce
 from .udp_tracker import udp_tracker_announce
+from .scrape import SCRAPE_CACHE, ScrapeResult
 import src.app_data.db_utils as db_utils
 
 
@@ -18,13 +20,49 @@ class Tracker(object):
         self.client_peer_id = peer_id
         self.state = None
 
-    async def re_announce(self, download: int, uploaded: int, left: int, event: int = 0):
+    @property
+    def swarm(self) -> Union[ScrapeResult, None]:
+        """
+        :return: the latest scrape of this torrent on the tracker, None if unknown
+        """
+        return SCRAPE_CACHE.get(self.url, self.info_hash)
+
+    @property
+    def seeders(self) -> Union[int, None]:
+        return self.swarm.seeders if self.swarm is not None else None
+
+    @property
+    def leechers(self) -> Union[int, None]:
+        return self.swarm.leechers if self.swarm is not None else None
+
+    @property
+    def completed(self) -> Union[int, None]:
+        return self.swarm.completed if self.swarm is not None else None
+
+    async def scrape(self) -> Union[ScrapeResult, None]:
+        return (await SCRAPE_CACHE.scrape(self.url, [self.info_hash])).get(self.info_hash)
+
+    async def re_announce(self, download: int, uploaded: int, left: int, event: int = 0, timeout_list: List[int] = None) -> List[Tuple[str, int]]:
+        """
+        :param timeout_list: udp retransmission timeouts, None for the protocol's
+        :return: the peers the tracker returned, empty if it failed
+        """
+        # a regular announce to a dead swarm brings no peers, events are always sent
+        if event == 0 and self.swarm is not None and self.swarm.dead:
+            self.state = 'dead swarm'
+            self.last_announce = time.time()
+            return []
+
         self.state = 'announcing'
-        port = db_utils.get_configuration('v4_forward')['external_port']
+        # the ipv6 listener shares the forwarded ipv4 port, its own port is used when ipv4 was never forwarded
+        port = db_utils.get_configuration('v4_forward')['external_port'] or db_utils.get_configuration('v6_forward')['external_port']
         try:
             response = ''
             if self.type == 'udp':
-                response = await udp_tracker_announce(self.url, self.info_hash, self.client_peer_id, download, uploaded, left, event, port)
+                if timeout_list is not None:
+                    response = await udp_tracker_announce(self.url, self.info_hash, self.client_peer_id, download, uploaded, left, event, port, timeout_list=timeout_list)
+                else:
+                    response = await udp_tracker_announce(self.url, self.info_hash, self.client_peer_id, download, uploaded, left, event, port)
 
             elif self.type == 'http':
                 response = await http_tracker_announce(self.url, self.info_hash, self.client_peer_id, download, uploaded, left, event, port)
@@ -32,14 +70,16 @@ class Tracker(object):
             if not isinstance(response, str):
                 self.state = 'working'
                 self.interval = response[1]
+                return response[0]
             else:
                 raise
 
-        except:
+        except Exception:
             self.state = 'unreachable'
             self.interval = math.inf
+            return []
         finally:
             self.last_announce = time.time()
 
     def __repr__(self):
-        return f"state: {self.state}, interval {self.interval}, url: {self.url}"
+        return f"state: {self.state}, interval {self.interval}, url: {self.url}, swarm: {self.swarm}"
@@ -1,16 +1,27 @@
 from .utils import format_announce_response
+from .resolver import RESOLVER
 import random
-from typing import Tuple, List, Union, Any
+from typing import Tuple, List, Union, Any, Dict, Callable
 import struct
 import asyncio
-import aioudp
 import socket
+import weakref
+import time
 
 
-__timeouts = (15, 30, 60, 120, 240, 480, 960, 1920, 3840)  # protocol timeouts for udp sockets
+__timeouts = (15, 30, 60, 120, 240, 480, 960, 1920, 3840)  # protocol timeouts for udp sockets, 15 * 2 ^ n
 
+_CONNECTION_ID_TTL = 60  # a connection_id may be reused for a minute (BEP 15)
+MAX_SCRAPE_HASHES = 74  # info_hashes that fit in one scrape packet
 
-def __format_url(tracker_url: str) -> Union[str, List[Tuple[Tuple[str, str], str]]]:
+# actions
+_CONNECT = 0
+_ANNOUNCE = 1
+_SCRAPE = 2
+_ERROR = 3
+
+
+async def __format_url(tracker_url: str) -> Union[str, List[Tuple[Tuple[str, str], str]]]:
     """
     formats an url to proper addresses and finds out the ip version of them
     :param tracker_url: raw tracker url
@@ -22,15 +33,15 @@ def __format_url(tracker_url: str) -> Union[str, List[Tuple[Tuple[str, str], str
 
     address = tracker_url.split(':')[0], int(tracker_url.split(':')[1])
     try:
-        result = socket.getaddrinfo(*address)
-        addresses = [((res[4][0], res[4][1]), 'v6' if ':' in res[4][0] else 'v4') for res in result]
+        result = await RESOLVER.resolve(*address, type=socket.SOCK_DGRAM)
+        addresses = [((res[1][0], res[1][1]), 'v6' if res[0] == socket.AF_INET6 else 'v4') for res in result]
     except socket.error as e:
         return 'failed resolve'
 
     return addresses
 
 
-def __build_connect_packet() -> bytes:
+def __build_connect_packet(transaction_id: int) -> bytes:
     """
     generates a udp connect packet
     :return: entire packet data
@@ -38,15 +49,16 @@ def __build_connect_packet() -> bytes:
     format_string = '>QII'
     data = struct.pack(format_string,
                        0x41727101980,  # connect magic number
-                       0,  # action - connect
-                       random.getrandbits(32))  # random transaction_id
+                       _CONNECT,  # action - connect
+                       transaction_id)
     return data
 
 
-def __build_announce_packet(connection_id: bytes, info_hash: bytes, peer_id: bytes, downloaded: int, uploaded: int, left: int, event: int, port: int, key: int) -> bytes:
+def __build_announce_packet(connection_id: bytes, transaction_id: int, info_hash: bytes, peer_id: bytes, downloaded: int, uploaded: int, left: int, event: int, port: int, key: int) -> bytes:
     """
     generates a udp announce packet
     :param connection_id:
+    :param transaction_id: matches the response to the request
     :param info_hash: info_hash of the torrent file
     :param peer_id: peer_id
     :param uploaded: uploaded
@@ -62,8 +74,8 @@ def __build_announce_packet(connection_id: bytes, info_hash: bytes, peer_id: byt
 
     data = struct.pack(format_string,
                        connection_id,
-                       1,  # action - announce
-                       random.getrandbits(32),  # transaction_id
+                       _ANNOUNCE,  # action - announce
+                       transaction_id,
                        info_hash,
                        peer_id,
                        downloaded,  # downloaded
@@ -78,42 +90,154 @@ def __build_announce_packet(connection_id: bytes, info_hash: bytes, peer_id: byt
     return data
 
 
-async def __udp_connection(request_data: bytes, address: Tuple[str, int], timeout: int) -> Union[bytes, str]:
+def __build_scrape_packet(connection_id: bytes, transaction_id: int, info_hashes: List[bytes]) -> bytes:
+    """
+    generates a udp scrape packet
+    :param info_hashes: up to _MAX_SCRAPE_HASHES info_hashes
+    :return: bytes of scrape packet
+    """
+    return struct.pack('>8sII', connection_id, _SCRAPE, transaction_id) + b''.join(info_hashes)
+
+
+class UDPTrackerProtocol(asyncio.DatagramProtocol):
+    """
+    one udp socket shared by every tracker request of an event loop (per address family)
+    responses are matched to their requests by transaction_id
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.transactions: Dict[int, asyncio.Future] = dict()
+        self.connecting: Dict[Tuple[str, int], asyncio.Task] = dict()  # connect requests in flight, per tracker address
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        if len(data) < 8:
+            return
+        transaction_id = struct.unpack_from('>I', data, 4)[0]
+        future = self.transactions.get(transaction_id)
+        if future is not None and not future.done():
+            future.set_result(data)
+
+    def error_received(self, exc):
+        pass  # icmp errors, the request times out and is retransmitted
+
+    def new_transaction(self) -> Tuple[int, asyncio.Future]:
+        transaction_id = random.getrandbits(32)
+        while transaction_id in self.transactions:
+            transaction_id = random.getrandbits(32)
+        future = asyncio.get_running_loop().create_future()
+        self.transactions[transaction_id] = future
+        return transaction_id, future
+
+    def end_transaction(self, transaction_id: int):
+        self.transactions.pop(transaction_id, None)
+
+
+# event loop -> address family -> endpoint (being) created in that loop
+_ENDPOINTS: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[int, asyncio.Future]]' = weakref.WeakKeyDictionary()
+# tracker address -> connection_id, expiry time
+_CONNECTION_IDS: Dict[Tuple[str, int], Tuple[bytes, float]] = dict()
+
+
+async def get_endpoint(family: int) -> UDPTrackerProtocol:
+    """
+    :param family: socket.AF_INET | socket.AF_INET6
+    :return: the shared endpoint of this address family in the running event loop
+    """
+    loop = asyncio.get_running_loop()
+    endpoints = _ENDPOINTS.setdefault(loop, dict())
+    if family not in endpoints:  # the first caller creates it, the rest wait for it
+        local_address = ('::', 0) if family == socket.AF_INET6 else ('0.0.0.0', 0)
+        endpoints[family] = loop.create_task(loop.create_datagram_endpoint(UDPTrackerProtocol, local_addr=local_address, family=family))
     try:
-        async with aioudp.connect(*address) as connection:
-            await connection.send(request_data)
-            data = await asyncio.wait_for(connection.recv(), timeout)
-            await asyncio.sleep(0.01)
-            return data
+        _, protocol = await asyncio.shield(endpoints[family])
+    except OSError:
+        endpoints.pop(family, None)  # no connectivity in this family, try again next time
+        raise
+    return protocol
 
-    except asyncio.TimeoutError:
-        return 'connection timeout'
-    except Exception as e:
-        # raise e
-        pass
+
+def close_endpoints():
+    """
+    closes the udp sockets of the running event loop, call before the loop ends
+    """
+    for endpoint in _ENDPOINTS.pop(asyncio.get_running_loop(), dict()).values():
+        if endpoint.done() and not endpoint.cancelled() and endpoint.exception() is None:
+            endpoint.result()[0].close()
 
 
-async def __get_connection_id(tracker_address: Tuple[str, int], timeout_list: List[int] = __timeouts) -> Union[bytes, None]:
+async def __transact(protocol: UDPTrackerProtocol, address: Tuple[str, int], build_packet: Callable[[int], bytes], timeout: int) -> Union[bytes, None]:
     """
-    gets a connection_id from tracker for announce / scrape
-    :param tracker_address: formatted tracker address
-    :param timeout_list: list that specifies how much time to wait before retransmission
-    :return: bytes: successfully received a connection_id. None: did not receive a connection_id
-     | raised exception: something went wrong
+    sends a request and waits for the response with the same transaction_id
+    :param build_packet: builds the request from the transaction_id
+    :return: response | None if timed out
     """
-    request_data = __build_connect_packet()
+    transaction_id, future = protocol.new_transaction()
+    try:
+        protocol.transport.sendto(build_packet(transaction_id), address)
+        return await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        return None
+    finally:
+        protocol.end_transaction(transaction_id)
 
-    for timeout in timeout_list:
 
-        data = await __udp_connection(request_data, tracker_address, timeout)
+async def __connect(protocol: UDPTrackerProtocol, address: Tuple[str, int], timeout: int) -> Union[bytes, None]:
+    """
+    requests a connection_id and caches it
+    :return: connect response | None if timed out
+    """
+    try:
+        data = await __transact(protocol, address, __build_connect_packet, timeout)
+        if data is not None and len(data) >= 16 and struct.unpack_from('>I', data)[0] == _CONNECT:
+            _CONNECTION_IDS[address] = data[8:16], time.monotonic() + _CONNECTION_ID_TTL
+        return data
+    finally:
+        protocol.connecting.pop(address, None)
 
-        if len(data) >= 16:
-            if data[4:8] == request_data[12:] and data[0:4] == request_data[8:12]:  # same transaction_id and action
-                # if received data passes checks, it's the right packet
-                connection_id = data[8:]
-                return connection_id
 
-    return None
+async def __request(address: Tuple[str, int], family: int, action: int, build_packet: Callable[[bytes, int], bytes], timeout_list: List[int]) -> Union[bytes, str]:
+    """
+    sends a request that needs a connection_id, following the BEP 15 retransmission schedule:
+    every timeout moves to the next (longer) one, an expired connection_id is requested again
+    :param build_packet: builds the request from the connection_id and the transaction_id
+    :return: response of the tracker | str: error message
+    """
+    protocol = await get_endpoint(family)
+
+    n = 0
+    while n < len(timeout_list):
+        cached = _CONNECTION_IDS.get(address)
+        if cached is None or cached[1] < time.monotonic():
+            # requests to the same tracker wait for one connect
+            if address not in protocol.connecting:
+                protocol.connecting[address] = asyncio.create_task(__connect(protocol, address, timeout_list[n]))
+            data = await asyncio.shield(protocol.connecting[address])
+            if data is None:
+                n += 1
+                continue
+            if len(data) < 16 or struct.unpack_from('>I', data)[0] != _CONNECT:
+                return "tracker is not reachable"
+            cached = _CONNECTION_IDS[address]
+
+        connection_id = cached[0]
+        data = await __transact(protocol, address, lambda transaction_id: build_packet(connection_id, transaction_id), timeout_list[n])
+        if data is None:
+            n += 1
+            continue
+
+        response_action = struct.unpack_from('>I', data)[0]
+        if response_action == _ERROR:
+            _CONNECTION_IDS.pop(address, None)  # the connection_id may have been refused
+            return data[8:].decode('utf-8', 'replace')
+        if response_action != action:
+            return "tracker is not reachable"
+        return data
+
+    return "tracker is not reachable"
 
 
 async def udp_tracker_announce(tracker_url: str, info_hash: bytes, peer_id: bytes, downloaded: int, uploaded: int, left: int, event: int, port: int, timeout_list: List[int] = __timeouts) \
@@ -131,38 +255,64 @@ async def udp_tracker_announce(tracker_url: str, info_hash: bytes, peer_id: byte
     :param timeout_list: list that specifies how much time to wait before retransmission
     :return: [0]: peer list, [1]: interval | str: exception
     """
-    tracker_addresses = __format_url(tracker_url)
+    tracker_addresses = await __format_url(tracker_url)
     if isinstance(tracker_addresses, str):
         return f"failed to resolve tracker url"
 
     # generate only one random key to follow protocol
     key = random.getrandbits(32)
-
-    async def _announce(address: Tuple[Tuple[str, int], str]):
-
-        # build the announce packet
-        connection_id = await __get_connection_id(address[0], timeout_list)
-        if connection_id is None:
+    # the same peers are usually listed by every address
+    seen = set()
+
+    async def _announce(address: Tuple[Tuple[str, int], str]) -> Union[Tuple[List[Tuple[str, int]], int], str]:
+        family = socket.AF_INET6 if address[1] == 'v6' else socket.AF_INET
+        try:
+            data = await __request(address[0], family, _ANNOUNCE, lambda connection_id, transaction_id: __build_announce_packet(
+                connection_id, transaction_id, info_hash, peer_id, downloaded, uploaded, left, event, port, key), timeout_list)
+        except OSError:
+            return f"tracker is not reachable"
+        if isinstance(data, str):
+            return data
+        if len(data) < 20:
             return f"tracker is not reachable"
+        return format_announce_response(data, address[1], seen)
 
-        request_data = __build_announce_packet(connection_id, info_hash, peer_id, downloaded, uploaded, left, event, port, key)
+    # announce to every address this tracker has at once
+    results = await asyncio.gather(*[_announce(address) for address in tracker_addresses])
+    responses = [result for result in results if not isinstance(result, str)]
+    if not responses:
+        return results[0] if results else f"tracker is not reachable"
 
-        for timeout in timeout_list:
+    lst = [peer for peers, _ in responses for peer in peers]
+    return lst, min(interval for _, interval in responses)
 
-            data = await __udp_connection(request_data, address[0], timeout)
 
-            if len(data) >= 20:
-                if request_data[12:16] == data[4:8] and request_data[8:12] == data[0:4]:  # same transaction_id and action
-                    return format_announce_response(data, address[1])
+async def udp_tracker_scrape(tracker_url: str, info_hashes: List[bytes], timeout_list: List[int] = __timeouts) -> Union[Dict[bytes, Tuple[int, int, int]], str]:
+    """
+    scrapes a udp tracker for several torrents at once
+    :param tracker_url: tracker udp url
+    :param info_hashes: up to MAX_SCRAPE_HASHES info_hashes
+    :param timeout_list: list that specifies how much time to wait before retransmission
+    :return: info_hash -> (seeders, leechers, completed) | str: exception
+    """
+    tracker_addresses = await __format_url(tracker_url)
+    if isinstance(tracker_addresses, str) or not tracker_addresses:
+        return f"failed to resolve tracker url"
+    info_hashes = info_hashes[:MAX_SCRAPE_HASHES]
 
+    # every address is the same tracker, one answer is enough
+    address, version = tracker_addresses[0]
+    family = socket.AF_INET6 if version == 'v6' else socket.AF_INET
+    try:
+        data = await __request(address, family, _SCRAPE, lambda connection_id, transaction_id: __build_scrape_packet(
+            connection_id, transaction_id, info_hashes), timeout_list)
+    except OSError:
         return f"tracker is not reachable"
-
-    # iterate over every address this tracker has
-    lst = []
-    for address in tracker_addresses:
-        peers, interval = await _announce(address)
-        if isinstance(peers, str):
-            return peers
-        else:
-            lst.extend(peers)
-    return lst, interval
+    if isinstance(data, str):
+        return data
+
+    results = dict()
+    count = min(len(info_hashes), (len(data) - 8) // 12)
+    for info_hash, (seeders, completed, leechers) in zip(info_hashes, struct.iter_unpack('>III', data[8:8 + 12 * count])):
+        results[info_hash] = seeders, leechers, completed
+    return results